@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+
+# Torrentverify decoder benchmark
+#
+# Compares the torrentverify Decoder with the reference Bencodepy based decoder
+# used up to version 0.1.0 on synthetic torrents with many files and pieces.
+#
+# Usage: benchmarks/bench_decoder.py [--files N] [--pieces N] [--repeat N]
+import os
+import sys
+import time
+import random
+import argparse
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import torrentverify
+
+# --- Reference decoder (torrentverify 0.1.1) ----------------------------------
+class ReferenceDecoder:
+  def __init__(self, data: bytes):
+    self.data = data
+    self.idx = 0
+
+  def __read(self, i: int) -> bytes:
+    b = self.data[self.idx: self.idx + i]
+    self.idx += i
+    if len(b) != i:
+      raise torrentverify.DecodingError('Unexpected End of File')
+    return b
+
+  def __read_to(self, terminator: bytes) -> bytes:
+    try:
+      i = self.data.index(terminator, self.idx)
+      b = self.data[self.idx:i]
+      self.idx = i + 1
+      return b
+    except ValueError:
+      raise torrentverify.DecodingError('Unable to locate terminator character')
+
+  def __parse(self) -> object:
+    char = self.data[self.idx: self.idx + 1]
+    if char in [b'1', b'2', b'3', b'4', b'5', b'6', b'7', b'8', b'9', b'0']:
+      str_len = int(self.__read_to(b':'))
+      return self.__read(str_len)
+    elif char == b'i':
+      self.idx += 1
+      return int(self.__read_to(b'e'))
+    elif char == b'd':
+      return self.__parse_dict()
+    elif char == b'l':
+      return self.__parse_list()
+    elif char == b'':
+      raise torrentverify.DecodingError('Unexpected End of File')
+    else:
+      raise torrentverify.DecodingError('Invalid token character')
+
+  def decode(self):
+    return self.__parse()
+
+  def __parse_dict(self) -> OrderedDict:
+    self.idx += 1
+    d = OrderedDict()
+    key_name = None
+    while self.data[self.idx: self.idx + 1] != b'e':
+      if key_name is None:
+        key_name = self.__parse()
+      else:
+        d[key_name] = self.__parse()
+        key_name = None
+    self.idx += 1
+    return d
+
+  def __parse_list(self) -> list:
+    self.idx += 1
+    l = []
+    while self.data[self.idx: self.idx + 1] != b'e':
+      l.append(self.__parse())
+    self.idx += 1
+    return l
+
+# --- Synthetic torrents -------------------------------------------------------
+def bencode(value):
+  if isinstance(value, int):
+    return b'i' + str(value).encode('ascii') + b'e'
+  if isinstance(value, bytes):
+    return str(len(value)).encode('ascii') + b':' + value
+  if isinstance(value, list):
+    return b'l' + b''.join(bencode(v) for v in value) + b'e'
+  if isinstance(value, dict):
+    return b'd' + b''.join(bencode(k) + bencode(value[k]) for k in sorted(value)) + b'e'
+  raise TypeError(type(value))
+
+def make_torrent_data(num_files, num_pieces):
+  rnd = random.Random(num_files * 31 + num_pieces)
+  files = []
+  for i in range(num_files):
+    path = [b'dir%03d' % (i % 500), b'file%07d.bin' % i]
+    files.append({b'path': path, b'length': rnd.randrange(1, 1 << 30)})
+  pieces = bytes(rnd.getrandbits(8) for i in range(20 * num_pieces))
+  info = {b'name': b'synthetic', b'piece length': 1 << 20, b'pieces': pieces, b'files': files}
+
+  return bencode({b'announce': b'http://localhost/announce', b'info': info})
+
+# --- Benchmark ----------------------------------------------------------------
+def best_time(function, repeat):
+  best = None
+  for i in range(repeat):
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    if best is None or elapsed < best:
+      best = elapsed
+
+  return best
+
+def decode_reference(data):
+  info = ReferenceDecoder(data).decode()[b'info']
+  for t_file in info[b'files']:
+    t_file[b'length']
+
+def decode_current(data):
+  info = torrentverify.Decoder(data).decode()[b'info']
+  for t_file in info[b'files']:
+    t_file[b'length']
+
+def decode_current_lazy(data):
+  decoder = torrentverify.Decoder(data, lazy_keys=(b'pieces', b'files'))
+  info = decoder.decode()[b'info']
+  for t_file in info[b'files']:
+    t_file[b'length']
+
+def check_same_result(data):
+  reference = ReferenceDecoder(data).decode()
+  current = torrentverify.Decoder(data).decode()
+  if reference != current:
+    print('ERROR Decoders return different results')
+    sys.exit(1)
+
+if __name__ == '__main__':
+  p = argparse.ArgumentParser()
+  p.add_argument('--files', help="Number of files in the torrents", type=int, default=300000)
+  p.add_argument('--pieces', help="Number of pieces in the torrents", type=int, default=1000000)
+  p.add_argument('--repeat', help="Number of repetitions", type=int, default=3)
+  args = p.parse_args()
+
+  print('   Files     Pieces    Size MB  Reference s    Current s     Lazy s  Speedup')
+  print('-------- ---------- ---------- ------------ ------------ ---------- --------')
+  for num_files, num_pieces in [(1, args.pieces), (args.files // 10, args.pieces // 10), (args.files, args.pieces)]:
+    data = make_torrent_data(num_files, num_pieces)
+    check_same_result(data)
+    reference_time = best_time(lambda: decode_reference(data), args.repeat)
+    current_time = best_time(lambda: decode_current(data), args.repeat)
+    lazy_time = best_time(lambda: decode_current_lazy(data), args.repeat)
+    print('{0:8,} {1:10,} {2:10.1f} {3:12.3f} {4:12.3f} {5:10.3f} {6:7.1f}x'
+      .format(num_files, num_pieces, len(data) / 1e6, reference_time, current_time,
+              lazy_time, reference_time / current_time))
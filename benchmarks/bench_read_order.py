@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+
+# Torrentverify read order benchmark
+#
+# Builds a fragmented download tree of many small files and compares the time
+# to hash it in logical piece order with --readOrder inode and physical.
+# Files are created in random order so inode order differs from piece order,
+# and their data is written in interleaved chunks so extents of different
+# files are mixed on disk. The page cache of the tree is dropped before every
+# run with posix_fadvise(), so run it on a real disk, not on tmpfs.
+#
+# Usage: benchmarks/bench_read_order.py [--dir DIR] [--files N] [--fileSize BYTES]
+#                                       [--chunkSize BYTES] [--repeat N]
+import os
+import sys
+import time
+import random
+import shutil
+import hashlib
+import tempfile
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import torrentverify
+from bench_decoder import bencode
+
+# --- Fragmented tree ----------------------------------------------------------
+def make_fragmented_tree(root, num_files, file_size, chunk_size):
+  rnd = random.Random(num_files)
+  name_list = ['dir{0:02d}/file{1:06d}.bin'.format(i % 16, i) for i in range(num_files)]
+  create_order = list(range(num_files))
+  rnd.shuffle(create_order)
+  fd_list = [None] * num_files
+  for i in create_order:
+    path = os.path.join(root, 'data', name_list[i])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd_list[i] = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+  # Write chunks round robin in random order, syncing every round, so the
+  # filesystem allocates blocks of different files next to each other
+  for offset in range(0, file_size, chunk_size):
+    rnd.shuffle(create_order)
+    for i in create_order:
+      os.write(fd_list[i], rnd.randbytes(min(chunk_size, file_size - offset)))
+    os.sync()
+  for fd in fd_list:
+    os.close(fd)
+
+  return name_list
+
+def make_torrent(root, name_list, piece_length):
+  hasher = hashlib.sha1()
+  piece_used = 0
+  pieces = []
+  files = []
+  for name in name_list:
+    with open(os.path.join(root, 'data', name), 'rb') as f:
+      data = f.read()
+    files.append({b'path': [p.encode() for p in name.split('/')], b'length': len(data)})
+    view = memoryview(data)
+    while len(view) > 0:
+      num_bytes = min(len(view), piece_length - piece_used)
+      hasher.update(view[:num_bytes])
+      piece_used += num_bytes
+      view = view[num_bytes:]
+      if piece_used == piece_length:
+        pieces.append(hasher.digest())
+        hasher = hashlib.sha1()
+        piece_used = 0
+  if piece_used > 0:
+    pieces.append(hasher.digest())
+  info = {b'name': b'data', b'piece length': piece_length, b'pieces': b''.join(pieces), b'files': files}
+  torrent_file = os.path.join(root, 'fragmented.torrent')
+  with open(torrent_file, 'wb') as f:
+    f.write(bencode({b'info': info}))
+
+  return torrent_file
+
+# --- Benchmark ----------------------------------------------------------------
+def drop_cache(torrent):
+  for i in range(torrent.num_files):
+    fd = os.open(torrentverify.torrent_file_path(torrent, i), os.O_RDONLY)
+    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    os.close(fd)
+
+def hash_torrent(torrent, read_order):
+  setattr(torrentverify, '__prog_options_readOrder', read_order)
+  torrentverify.take_file_stat_snapshot(torrent)
+  drop_cache(torrent)
+  start = time.perf_counter()
+  num_bad = 0
+  for piece_hash, file_idx_list, piece_idx in torrentverify.hashed_pieces_generator(torrent):
+    if piece_hash != torrent.pieces_hash_list[piece_idx]:
+      num_bad += 1
+  elapsed = time.perf_counter() - start
+  if num_bad:
+    print('ERROR {0} bad pieces with --readOrder {1}'.format(num_bad, read_order))
+    sys.exit(1)
+
+  return elapsed
+
+if __name__ == '__main__':
+  p = argparse.ArgumentParser()
+  p.add_argument('--dir', help="Directory for the test tree (default: a temporary directory here)")
+  p.add_argument('--files', help="Number of files", type=int, default=4000)
+  p.add_argument('--fileSize', help="Size of every file in bytes", type=int, default=64 * 1024)
+  p.add_argument('--chunkSize', help="Size of interleaved writes in bytes", type=int, default=16 * 1024)
+  p.add_argument('--pieceLength', help="Piece length in bytes", type=int, default=256 * 1024)
+  p.add_argument('--repeat', help="Number of repetitions", type=int, default=3)
+  args = p.parse_args()
+
+  root = tempfile.mkdtemp(prefix='bench_read_order_', dir=args.dir or '.')
+  try:
+    print('Creating {0:,} files of {1:,} bytes in {2}'.format(args.files, args.fileSize, root))
+    name_list = make_fragmented_tree(root, args.files, args.fileSize, args.chunkSize)
+    torrent_file = make_torrent(root, name_list, args.pieceLength)
+    torrent = torrentverify.extract_torrent_metadata(torrent_file, quiet=True)
+    torrentverify.set_torrent_data_directory(torrent, root)
+
+    print('Read order      Best s    MB/s  Speedup')
+    print('---------- ---------- ------- --------')
+    total_mb = args.files * args.fileSize / 1e6
+    logical_time = None
+    for read_order in ['logical', 'inode', 'physical']:
+      best = min(hash_torrent(torrent, read_order) for i in range(args.repeat))
+      if logical_time is None:
+        logical_time = best
+      print('{0:10} {1:10.3f} {2:7.1f} {3:7.2f}x'
+        .format(read_order, best, total_mb / best, logical_time / best))
+  finally:
+    shutil.rmtree(root)
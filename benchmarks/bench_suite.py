@@ -0,0 +1,248 @@
+#!/usr/bin/python3
+
+# Torrentverify benchmark suite
+#
+# Builds deterministic synthetic downloads and their .torrent files in a
+# temporary directory and times the main stages of torrentverify on them:
+# bdecoding, metadata extraction, piece/file mapping, size check (--check),
+# unneeded files scan (--checkUnneeded), piece hashing and the full hash
+# check (--checkHash). Results are written as JSON so runs of different
+# commits can be compared with --compare.
+#
+# Datasets:
+#   huge      few huge files
+#   tiny      very many tiny files
+#   boundary  files of odd sizes so most of them span piece boundaries
+#   damaged   missing, short and padded files plus unneeded files
+#
+# Usage: benchmarks/bench_suite.py [--dir DIR] [--scale X] [--repeat N]
+#                                  [--output results.json] [--compare old.json]
+import os
+import sys
+import time
+import json
+import random
+import shutil
+import hashlib
+import platform
+import tempfile
+import argparse
+import subprocess
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import torrentverify
+from bench_decoder import bencode
+
+__results_version = 1
+
+# --- Synthetic datasets -------------------------------------------------------
+# Returns a list of (relative path, size) of every dataset. scale multiplies
+# the number of files of tiny datasets and the size of huge files.
+def get_dataset_files(name, scale):
+  rnd = random.Random(name)
+  if name == 'huge':
+    return [('huge{0}.bin'.format(i), int(48 * 1024 * 1024 * scale) + i * 12345) for i in range(3)]
+  if name == 'tiny':
+    return [('d{0:03d}/tiny{1:06d}.txt'.format(i % 200, i), rnd.randrange(1, 512))
+            for i in range(int(20000 * scale))]
+  if name == 'boundary':
+    return [('b{0:02d}/odd{1:05d}.bin'.format(i % 20, i), rnd.randrange(1, 3 * 65536))
+            for i in range(int(1000 * scale))]
+  if name == 'damaged':
+    return [('dmg{0:02d}/file{1:05d}.bin'.format(i % 10, i), rnd.randrange(1, 128 * 1024))
+            for i in range(int(500 * scale))]
+  raise ValueError(name)
+
+def get_dataset_piece_length(name):
+  return {'huge' : 4 * 1024 * 1024, 'tiny' : 64 * 1024, 'boundary' : 64 * 1024, 'damaged' : 32 * 1024}[name]
+
+# Writes the files of a dataset with deterministic contents
+def write_dataset(data_dir, name, file_list):
+  rnd = random.Random(name)
+  block = rnd.randbytes(1024 * 1024 + 4096)
+  for file_idx, (path, size) in enumerate(file_list):
+    full_path = os.path.join(data_dir, path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    with open(full_path, 'wb') as f:
+      written = 0
+      while written < size:
+        start = (file_idx * 7919 + written) % 4096
+        num_bytes = min(size - written, 1024 * 1024)
+        f.write(block[start:start + num_bytes])
+        written += num_bytes
+
+# Hashes the files of a dataset and writes its .torrent file
+def write_torrent(torrent_file, name, data_dir, file_list, piece_length):
+  pieces = []
+  hasher = hashlib.sha1()
+  piece_used = 0
+  for path, size in file_list:
+    with open(os.path.join(data_dir, path), 'rb') as f:
+      while True:
+        data = f.read(piece_length - piece_used)
+        if not data:
+          break
+        hasher.update(data)
+        piece_used += len(data)
+        if piece_used == piece_length:
+          pieces.append(hasher.digest())
+          hasher = hashlib.sha1()
+          piece_used = 0
+  if piece_used > 0:
+    pieces.append(hasher.digest())
+  files = [{b'path' : [p.encode() for p in path.split('/')], b'length' : size} for path, size in file_list]
+  info = {b'name' : name.encode(), b'piece length' : piece_length, b'pieces' : b''.join(pieces), b'files' : files}
+  with open(torrent_file, 'wb') as f:
+    f.write(bencode({b'announce' : b'http://localhost/announce', b'info' : info}))
+
+# Removes, truncates and pads some files and adds unneeded files
+def damage_dataset(data_dir, file_list):
+  rnd = random.Random('damage')
+  for file_idx, (path, size) in enumerate(file_list):
+    full_path = os.path.join(data_dir, path)
+    action = rnd.randrange(20)
+    if action == 0:
+      os.unlink(full_path)
+    elif action == 1:
+      os.truncate(full_path, size // 2)
+    elif action == 2:
+      with open(full_path, 'ab') as f:
+        f.write(bytes(rnd.randrange(1, 4096)))
+  for i in range(len(file_list) // 10):
+    extra_path = os.path.join(data_dir, 'unneeded{0:02d}'.format(i % 7), 'extra{0:05d}.tmp'.format(i))
+    os.makedirs(os.path.dirname(extra_path), exist_ok=True)
+    with open(extra_path, 'wb') as f:
+      f.write(bytes(i % 1000))
+
+def make_dataset(root, name, scale):
+  file_list = get_dataset_files(name, scale)
+  data_dir = os.path.join(root, 'download', name)
+  torrent_file = os.path.join(root, name + '.torrent')
+  write_dataset(data_dir, name, file_list)
+  write_torrent(torrent_file, name, data_dir, file_list, get_dataset_piece_length(name))
+  if name == 'damaged':
+    damage_dataset(data_dir, file_list)
+
+  return (torrent_file, file_list)
+
+# --- Benchmarks ---------------------------------------------------------------
+def best_time(function, repeat):
+  best = None
+  for i in range(repeat):
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    if best is None or elapsed < best:
+      best = elapsed
+
+  return best
+
+# Runs function with the output of torrentverify discarded
+def run_quiet(function, *args):
+  report_output = getattr(torrentverify, '__report_output')
+  with open(os.devnull, 'w') as devnull:
+    old_stream = report_output.stream
+    report_output.stream = devnull
+    try:
+      with contextlib.redirect_stdout(devnull):
+        return function(*args)
+    finally:
+      report_output.stream = old_stream
+
+def map_pieces_and_files(torrent):
+  for piece_idx in range(torrent.num_pieces):
+    torrentverify.get_piece_files(torrent, piece_idx)
+  for file_idx in range(torrent.num_files):
+    torrentverify.get_file_pieces(torrent, file_idx)
+
+def hash_pieces(torrent):
+  torrentverify.take_file_stat_snapshot(torrent)
+  for piece in torrentverify.hashed_pieces_generator(torrent):
+    pass
+
+def bench_dataset(root, name, torrent_file, file_list, repeat):
+  with open(torrent_file, 'rb') as f:
+    data = f.read()
+  torrent = run_quiet(torrentverify.extract_torrent_metadata, torrent_file)
+  torrentverify.set_torrent_data_directory(torrent, os.path.join(root, 'download'))
+  timings = {}
+  timings['decode'] = best_time(lambda: torrentverify.Decoder(data).decode(), repeat)
+  timings['metadata'] = best_time(lambda: run_quiet(torrentverify.extract_torrent_metadata, torrent_file), repeat)
+  timings['mapping'] = best_time(lambda: map_pieces_and_files(torrent), repeat)
+  timings['check'] = best_time(lambda: run_quiet(torrentverify.check_torrent_files_only, torrent), repeat)
+  timings['check_unneeded'] = best_time(lambda: run_quiet(torrentverify.check_torrent_unneeded_files, torrent), repeat)
+  timings['hash_pieces'] = best_time(lambda: hash_pieces(torrent), repeat)
+  timings['check_hash'] = best_time(lambda: run_quiet(torrentverify.check_torrent_files_hash, torrent), repeat)
+
+  return {
+    'files'        : len(file_list),
+    'total_bytes'  : sum(size for path, size in file_list),
+    'pieces'       : torrent.num_pieces,
+    'piece_length' : torrent.piece_length,
+    'timings'      : timings
+  }
+
+def get_git_commit():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                   cwd=os.path.dirname(os.path.abspath(__file__)),
+                                   stderr=subprocess.DEVNULL).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def print_results(results, old_results):
+  print('Dataset        Stage               Best s      Old s   Change')
+  print('-------------- -------------- ---------- ---------- --------')
+  for name, dataset in results['datasets'].items():
+    for stage, seconds in dataset['timings'].items():
+      old_seconds = None
+      if old_results is not None:
+        old_seconds = old_results['datasets'].get(name, {}).get('timings', {}).get(stage)
+      if old_seconds:
+        print('{0:14} {1:14} {2:10.4f} {3:10.4f} {4:+7.1f}%'
+          .format(name, stage, seconds, old_seconds, 100.0 * (seconds - old_seconds) / old_seconds))
+      else:
+        print('{0:14} {1:14} {2:10.4f}'.format(name, stage, seconds))
+
+if __name__ == '__main__':
+  p = argparse.ArgumentParser()
+  p.add_argument('--dir', help="Directory for the datasets (default: a temporary directory)")
+  p.add_argument('--scale', help="Multiplier of dataset sizes", type=float, default=1.0)
+  p.add_argument('--repeat', help="Number of repetitions", type=int, default=3)
+  p.add_argument('--datasets', help="Datasets to run", nargs='+',
+                 choices=['huge', 'tiny', 'boundary', 'damaged'], default=['huge', 'tiny', 'boundary', 'damaged'])
+  p.add_argument('--output', help="JSON results file", default='bench_results.json')
+  p.add_argument('--compare', help="JSON results of a previous run to compare with")
+  args = p.parse_args()
+
+  # Hash every time, do not use or fill the verification cache
+  setattr(torrentverify, '__prog_options_noCache', 1)
+
+  root = tempfile.mkdtemp(prefix='bench_suite_', dir=args.dir)
+  try:
+    results = {
+      'version'   : __results_version,
+      'commit'    : get_git_commit(),
+      'python'    : platform.python_version(),
+      'platform'  : platform.platform(),
+      'scale'     : args.scale,
+      'repeat'    : args.repeat,
+      'datasets'  : {}
+    }
+    for name in args.datasets:
+      sys.stderr.write('Building dataset {0}...\n'.format(name))
+      torrent_file, file_list = make_dataset(root, name, args.scale)
+      sys.stderr.write('Running dataset {0}...\n'.format(name))
+      results['datasets'][name] = bench_dataset(root, name, torrent_file, file_list, args.repeat)
+  finally:
+    shutil.rmtree(root)
+
+  with open(args.output, 'w') as f:
+    json.dump(results, f, indent=2)
+  old_results = None
+  if args.compare:
+    with open(args.compare) as f:
+      old_results = json.load(f)
+  print_results(results, old_results)
+  print('Results written to {0}'.format(args.output))
@@ -0,0 +1,42 @@
+# Tests of the --prefetch reading pipeline
+import os
+import re
+import tempfile
+import unittest
+
+from torrent_fixture import make_torrent, run_torrentverify
+
+class PrefetchTest(unittest.TestCase):
+  def setUp(self):
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.root = self.temp_dir.name
+    self.torrent_path = os.path.join(self.root, 'good.torrent')
+    # 6 pieces of 64 KiB, the last file ends on a piece boundary
+    make_torrent(self.torrent_path, os.path.join(self.root, 'dl'), 'good',
+                 [('a.bin', 100000), ('sub/b.bin', 50000), ('c.bin', 243216)], 65536)
+
+  def tearDown(self):
+    self.temp_dir.cleanup()
+
+  def check_good(self, extra_arg_list):
+    ret_value, output = run_torrentverify(
+      ['-t', self.torrent_path, '-d', os.path.join(self.root, 'dl'), '--checkHash',
+       '--noCache', '--format', 'summary'] + extra_arg_list, os.path.join(self.root, 'cache'))
+    self.assertEqual(ret_value, 0, output)
+    self.assertRegex(output, re.compile(r'^Good pieces\s*:\s*6$', re.MULTILINE))
+    self.assertRegex(output, re.compile(r'^Bad pieces\s*:\s*0$', re.MULTILINE))
+
+  def test_serial(self):
+    self.check_good([])
+
+  # Pieces that end exactly at the end of a buffer
+  def test_buffer_size_divides_piece_length(self):
+    self.check_good(['--prefetch', '4', '--bufferSize', '65536'])
+    self.check_good(['--prefetch', '2', '--bufferSize', '4096'])
+    self.check_good(['--prefetch', '3', '--bufferSize', '65536', '--mmap'])
+
+  def test_buffer_size_not_dividing_piece_length(self):
+    self.check_good(['--prefetch', '2', '--bufferSize', '40000'])
+
+if __name__ == '__main__':
+  unittest.main()
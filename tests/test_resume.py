@@ -0,0 +1,76 @@
+# Tests of the libtorrent resume file written by --writeResume
+import os
+import hashlib
+import tempfile
+import unittest
+
+import torrentverify
+from torrent_fixture import make_torrent, run_torrentverify
+
+fixture_file_list = [('a.bin', 1000), ('sub/b.bin', 3000), ('c.bin', 2500)]
+fixture_piece_length = 1024
+
+class ResumeTest(unittest.TestCase):
+  def setUp(self):
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.root = self.temp_dir.name
+    self.torrent_path = os.path.join(self.root, 'multi.torrent')
+    self.data_dir = os.path.join(self.root, 'dl')
+    self.files_dir, self.info = make_torrent(self.torrent_path, self.data_dir, 'multi',
+                                             fixture_file_list, fixture_piece_length)
+    # Byte 1,100 of the torrent is in piece 1
+    with open(os.path.join(self.files_dir, 'sub', 'b.bin'), 'r+b') as data_file:
+      data_file.seek(100)
+      byte = data_file.read(1)
+      data_file.seek(100)
+      data_file.write(bytes([byte[0] ^ 0xff]))
+
+  def tearDown(self):
+    self.temp_dir.cleanup()
+
+  def write_resume(self, extra_arg_list):
+    resume_path = os.path.join(self.root, 'multi.resume')
+    ret_value, output = run_torrentverify(
+      ['-t', self.torrent_path, '--checkHash', '--noCache', '--format', 'summary',
+       '--writeResume', resume_path] + extra_arg_list, os.path.join(self.root, 'cache'))
+    self.assertEqual(ret_value, 1, output)
+    with open(resume_path, 'rb') as resume_file:
+      return torrentverify.Decoder(resume_file.read()).decode()
+
+  def check_resume(self, resume):
+    self.assertEqual(resume[b'file-format'], b'libtorrent resume file')
+    self.assertEqual(resume[b'name'], b'multi')
+    info_hash = resume[b'info-hash']
+    self.assertEqual(len(info_hash), 20)
+    self.assertEqual(info_hash, hashlib.sha1(torrentverify.Encoder().encode(self.info)).digest())
+    self.assertEqual(resume[b'pieces'], bytes([1, 0, 1, 1, 1, 1, 1]))
+    self.assertEqual(resume[b'completed_time'], 0)
+    file_size_list = resume[b'file sizes']
+    self.assertEqual(len(file_size_list), len(fixture_file_list))
+    for (path, size), file_size in zip(fixture_file_list, file_size_list):
+      self.assertEqual(len(file_size), 2)
+      self.assertTrue(all(isinstance(value, int) for value in file_size))
+      file_stat = os.stat(os.path.join(self.files_dir, path))
+      self.assertEqual(file_size, [size, int(file_stat.st_mtime)])
+
+  def test_torrent_directory(self):
+    resume = self.write_resume(['-d', self.data_dir])
+    self.check_resume(resume)
+    self.assertEqual(resume[b'save_path'], os.path.abspath(self.data_dir).encode('utf-8'))
+    self.assertNotIn(b'mapped_files', resume)
+
+  def test_override_torrent_directory(self):
+    resume = self.write_resume(['-d', self.files_dir, '--otd'])
+    self.check_resume(resume)
+    self.assertEqual(resume[b'save_path'], os.path.abspath(self.files_dir).encode('utf-8'))
+    self.assertEqual(resume[b'mapped_files'], [path.encode('utf-8') for path, size in fixture_file_list])
+
+  def test_missing_file(self):
+    os.remove(os.path.join(self.files_dir, 'c.bin'))
+    resume = self.write_resume(['-d', self.data_dir])
+    # Pieces 3 to 6 have data of c.bin
+    self.assertEqual(resume[b'pieces'], bytes([1, 0, 1, 0, 0, 0, 0]))
+    self.assertEqual(resume[b'file sizes'][2], [0, 0])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,50 @@
+# Torrentverify test fixtures
+#
+# Builds small deterministic downloads and their .torrent files and runs
+# torrentverify.py on them as a command line program.
+import os
+import sys
+import random
+import hashlib
+import subprocess
+
+__test_dir = os.path.dirname(os.path.abspath(__file__))
+script_path = os.path.join(__test_dir, '..', 'torrentverify.py')
+sys.path.insert(0, os.path.join(__test_dir, '..'))
+import torrentverify
+
+# Writes the files of file_list, a list of (relative path, size), to
+# data_dir and a torrent of them to torrent_path. Multi file torrents are
+# named name and their files go to data_dir/name. Returns the directory the
+# files were written to and the info dictionary.
+def make_torrent(torrent_path, data_dir, name, file_list, piece_length, single_file=False):
+  rnd = random.Random(len(file_list) * 31 + piece_length)
+  files_dir = data_dir if single_file else os.path.join(data_dir, name)
+  data = bytearray()
+  for path, size in file_list:
+    file_path = os.path.join(files_dir, path)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    file_data = bytes(rnd.getrandbits(8) for i in range(size))
+    with open(file_path, 'wb') as data_file:
+      data_file.write(file_data)
+    data += file_data
+  pieces = b''.join(hashlib.sha1(data[i:i + piece_length]).digest()
+                    for i in range(0, len(data), piece_length))
+  if single_file:
+    info = {'name' : file_list[0][0], 'piece length' : piece_length, 'pieces' : pieces,
+            'length' : file_list[0][1]}
+  else:
+    info = {'name' : name, 'piece length' : piece_length, 'pieces' : pieces,
+            'files' : [{'path' : path.split('/'), 'length' : size} for path, size in file_list]}
+  with open(torrent_path, 'wb') as torrent_file:
+    torrent_file.write(torrentverify.Encoder().encode({'announce' : 'http://localhost/', 'info' : info}))
+
+  return (files_dir, info)
+
+# Runs torrentverify.py with the argument list. Returns (exit code, output).
+def run_torrentverify(arg_list, cache_dir):
+  env = dict(os.environ, XDG_CACHE_HOME=cache_dir, COLUMNS='200')
+  process = subprocess.run([sys.executable, script_path] + arg_list, env=env,
+                           stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+  return (process.returncode, process.stdout.decode('utf-8', 'replace'))
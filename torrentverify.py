@@ -24,13 +24,29 @@
 # Bencoder code based on Bencodepy by Eric Weast (c) 2014
 # Licensed under the GPL v2
 # https://github.com/eweast/BencodePy/commits/master
-import io
 import sys
 import os
 import hashlib
 import argparse
 import shutil
-from collections import OrderedDict
+import threading
+import queue
+import stat
+import json
+import mmap
+import ctypes
+import ctypes.util
+import struct
+import time
+import random
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from array import array
+from bisect import bisect_left
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
 
 # --- Global variables
 __software_version = '0.1.0';
@@ -40,19 +56,62 @@ __prog_options_override_torrent_dir = 0
 __prog_options_deleteWrongSizeFiles = 0
 __prog_options_truncateWrongSizeFiles = 0
 __prog_options_deleteUnneeded = 0
+__prog_options_jobs = 1
+__prog_options_prefetch = 0
+__prog_options_deviceJobs = 0
+__prog_options_readOrder = 'logical'
+__prog_options_format = 'table'
+__prog_options_allPieces = 0
+__prog_options_v2 = 0
+__prog_options_sampleSeed = None
+__prog_options_failFast = 0
+__prog_options_perFileStop = 0
+__prog_options_progress = 0
+__prog_options_statJobs = 1
+__prog_options_unneededSizes = 0
+__prog_options_fadvise = 0
+__prog_options_directIO = 0
+__prog_options_mmap = 0
+__prog_options_cacheResidency = 0
+__prog_options_noCache = 0
+__prog_options_rehash = 0
+
+# Maximum number of files kept open by the piece reader
+__max_open_files = 64
 
 # Unified torrent information object. Works for torrent files with 1 or several
 # files.
 class Torrent:
-  torrent_file = None
-  dir_name = None
-  piece_length = 0
-  num_pieces = 0
-  num_files = 0
-  file_name_list = []
-  file_length_list = []
-  pieces_hash_list = []
-  pieces_file_list = []
+  def __init__(self):
+    self.torrent_file = None
+    self.info_hash = None
+    self.dir_name = None
+    self.dir_download = None
+    self.dir_data = None
+    self.piece_length = 0
+    self.num_pieces = 0
+    self.num_files = 0
+    self.total_bytes = 0
+    self.file_name_list = []
+    self.file_length_list = []
+    self.pieces_hash_list = None
+    self.file_offset_list = array('Q')
+    # Indices of BEP 47 pad files. They are not stored on disk and are
+    # hashed as zeros.
+    self.pad_file_set = set()
+    # BitTorrent v2 (BEP 52) metadata. meta_version is 2 for v2 and hybrid
+    # torrents. v2_file_dict maps file index -> pieces root of every file
+    # with data and piece_layers pieces root -> piece hashes.
+    self.meta_version = 1
+    self.info_hash_v2 = None
+    self.v2_file_dict = {}
+    self.piece_layers = {}
+    # Files with a bad piece whose remaining pieces are not read
+    # (--perFileStop)
+    self.stopped_file_set = set()
+    # After a hash check, one byte per piece (v2 pieces for v2 checks), 1 if
+    # the piece is good
+    self.have_pieces = None
 
 # --- Get size of terminal ---
 # shutil.get_terminal_size() only available in Python 3.3
@@ -75,87 +134,520 @@ class DecodingError(Exception):
   def __str__(self):
     return repr(self.msg)
 
+class EncodingError(Exception):
+  def __init__(self, msg):
+    self.msg = msg
+
+  def __str__(self):
+    return repr(self.msg)
+
+# Bencoded list whose elements are decoded one at a time when iterated. Used
+# for huge values like the list of files so they are never fully decoded in
+# memory.
+class LazyList:
+  def __init__(self, decoder, start: int, length: int):
+    self.decoder = decoder
+    self.start = start
+    self.length = length
+
+  def __len__(self):
+    return self.length
+
+  def __iter__(self):
+    idx = self.start + 1
+    for i in range(self.length):
+      value, idx = self.decoder.decode_value(idx)
+      yield value
+
+# Decoder works with integer offsets over the data and only slices it to
+# return strings. Values of keys in lazy_keys are not decoded: strings are
+# returned as a memoryview over the data (no copy) and lists as a LazyList.
 class Decoder:
-  def __init__(self, data: bytes):
-    self.data = data
-    self.idx = 0
-
-  def __read(self, i: int) -> bytes:
-    """Returns a set number (i) of bytes from self.data."""
-    b = self.data[self.idx: self.idx + i]
-    self.idx += i
-    if len(b) != i:
-      raise DecodingError(
-         "Incorrect byte length returned between indexes of {0} and {1}. Possible unexpected End of File."
-         .format(str(self.idx), str(self.idx - i)))
-    return b
-
-  def __read_to(self, terminator: bytes) -> bytes:
-    """Returns bytes from self.data starting at index (self.idx) until terminator character."""
-    try:
-      # noinspection PyTypeChecker
-      i = self.data.index(terminator, self.idx)
-      b = self.data[self.idx:i]
-      self.idx = i + 1
-      return b
-    except ValueError:
-      raise DecodingError(
-          'Unable to locate terminator character "{0}" after index {1}.'.format(str(terminator), str(self.idx)))
-
-  def __parse(self) -> object:
-    """Selects the appropriate method to decode next bencode element and returns the result."""
-    char = self.data[self.idx: self.idx + 1]
-    if char in [b'1', b'2', b'3', b'4', b'5', b'6', b'7', b'8', b'9', b'0']:
-      str_len = int(self.__read_to(b':'))
-      return self.__read(str_len)
-    elif char == b'i':
-      self.idx += 1
-      return int(self.__read_to(b'e'))
-    elif char == b'd':
-      return self.__parse_dict()
-    elif char == b'l':
-      return self.__parse_list()
-    elif char == b'':
-      raise DecodingError('Unexpected End of File at index position of {0}.'.format(str(self.idx)))
-    else:
-      raise DecodingError('Invalid token character ({0}) at position {1}.'.format(str(char), str(self.idx)))
+  def __init__(self, data: bytes, lazy_keys=()):
+    self.data = bytes(data)
+    self.view = memoryview(self.data)
+    self.lazy_keys = frozenset(lazy_keys)
+    # Key -> (start, end) index of the values in the root dictionary. Used
+    # to compute the info-hash from the raw info dictionary.
+    self.root_value_spans = {}
+    # decode_value(idx) decodes the element at index idx and returns
+    # (value, index after the element)
+    self.decode_value = self.__make_value_decoder()
 
   def decode(self):
     """Start of decode process. Returns final results."""
     if self.data[0:1] not in (b'd', b'l'):
       return self.__wrap_with_tuple()
-    return self.__parse()
+    try:
+      if self.data[0:1] == b'l':
+        return self.decode_value(0)[0]
+      # Root dictionary, remember where every value is
+      data = self.data
+      idx = 1
+      d = {}
+      while data[idx] != 101: # e
+        key_name, idx = self.decode_value(idx)
+        value_start = idx
+        if key_name in self.lazy_keys:
+          d[key_name], idx = self.__decode_lazy(idx)
+        else:
+          d[key_name], idx = self.decode_value(idx)
+        self.root_value_spans[key_name] = (value_start, idx)
+      return d
+    except IndexError:
+      raise DecodingError('Unexpected End of File at index position of {0}.'.format(str(len(self.data))))
 
   def __wrap_with_tuple(self) -> tuple:
     """Returns a tuple of all nested bencode elements."""
     l = list()
+    idx = 0
     length = len(self.data)
-    while self.idx < length:
-      l.append(self.__parse())
+    try:
+      while idx < length:
+        value, idx = self.decode_value(idx)
+        l.append(value)
+    except IndexError:
+      raise DecodingError('Unexpected End of File at index position of {0}.'.format(str(length)))
     return tuple(l)
 
-  def __parse_dict(self) -> OrderedDict:
-    """Returns an Ordered Dictionary of nested bencode elements."""
-    self.idx += 1
-    d = OrderedDict()
-    key_name = None
-    while self.data[self.idx: self.idx + 1] != b'e':
-      if key_name is None:
-        key_name = self.__parse()
+  def __make_value_decoder(self):
+    """Returns the recursive decoding function. It is a closure so the data
+    and helpers are fast local variables. Running past the end of the data
+    raises IndexError, callers convert it into a DecodingError."""
+    data = self.data
+    find = data.find
+    lazy_keys = self.lazy_keys
+    decode_lazy = self.__decode_lazy
+
+    def decode_string(idx):
+      # Fast path: parse the length digits in place, no slicing
+      length = 0
+      char = data[idx]
+      while char != 58: # :
+        char -= 48
+        if char < 0 or char > 9:
+          raise DecodingError('Invalid string length at position {0}.'.format(str(idx)))
+        length = length * 10 + char
+        idx += 1
+        char = data[idx]
+      idx += 1
+      end = idx + length
+      if end > len(data):
+        raise DecodingError(
+          "Incorrect byte length returned between indexes of {0} and {1}. Possible unexpected End of File."
+          .format(str(idx), str(end)))
+      return (data[idx:end], end)
+
+    def decode_value(idx):
+      char = data[idx]
+      # Strings are by far the most common element, check them first
+      if 48 <= char <= 57:
+        return decode_string(idx)
+      elif char == 100: # d
+        idx += 1
+        d = {}
+        while data[idx] != 101: # e
+          key_name, idx = decode_string(idx)
+          if lazy_keys and key_name in lazy_keys:
+            d[key_name], idx = decode_lazy(idx)
+          else:
+            d[key_name], idx = decode_value(idx)
+        return (d, idx + 1)
+      elif char == 108: # l
+        idx += 1
+        l = []
+        while data[idx] != 101: # e
+          value, idx = decode_value(idx)
+          l.append(value)
+        return (l, idx + 1)
+      elif char == 105: # i
+        end = find(b'e', idx)
+        if end < 0:
+          raise DecodingError(
+            'Unable to locate terminator character "{0}" after index {1}.'.format(str(b'e'), str(idx)))
+        return (int(data[idx + 1:end]), end + 1)
+      raise DecodingError('Invalid token character ({0}) at position {1}.'.format(str(data[idx:idx + 1]), str(idx)))
+
+    def checked_decode_value(idx):
+      try:
+        return decode_value(idx)
+      except IndexError:
+        raise DecodingError('Unexpected End of File at index position of {0}.'.format(str(len(data))))
+
+    self.__unchecked_decode_value = decode_value
+    return checked_decode_value
+
+  def __decode_lazy(self, idx: int) -> tuple:
+    """Returns a string as a memoryview and a list as a LazyList."""
+    char = self.data[idx]
+    if 48 <= char <= 57:
+      end = self.__skip(idx)
+      start = self.data.find(b':', idx) + 1
+      return (self.view[start:end], end)
+    elif char == 108: # l
+      start = idx
+      length = 0
+      idx += 1
+      while self.data[idx] != 101: # e
+        idx = self.__skip(idx)
+        length += 1
+      return (LazyList(self, start, length), idx + 1)
+    return self.__unchecked_decode_value(idx)
+
+  def __skip(self, idx: int) -> int:
+    """Returns the index after the element at idx without decoding it."""
+    data = self.data
+    depth = 0
+    while True:
+      char = data[idx]
+      if 48 <= char <= 57:
+        length = 0
+        while char != 58: # :
+          char -= 48
+          if char < 0 or char > 9:
+            raise DecodingError('Invalid string length at position {0}.'.format(str(idx)))
+          length = length * 10 + char
+          idx += 1
+          char = data[idx]
+        idx += 1 + length
+      elif char == 100 or char == 108: # d or l
+        depth += 1
+        idx += 1
+        continue
+      elif char == 101: # e
+        depth -= 1
+        idx += 1
+      elif char == 105: # i
+        end = data.find(b'e', idx)
+        if end < 0:
+          raise DecodingError(
+            'Unable to locate terminator character "{0}" after index {1}.'.format(str(b'e'), str(idx)))
+        idx = end + 1
       else:
-        d[key_name] = self.__parse()
-        key_name = None
-    self.idx += 1
-    return d
-
-  def __parse_list(self) -> list:
-    """Returns an list of nested bencode elements."""
-    self.idx += 1
-    l = []
-    while self.data[self.idx: self.idx + 1] != b'e':
-      l.append(self.__parse())
-    self.idx += 1
-    return l
+        raise DecodingError('Invalid token character ({0}) at position {1}.'.format(str(data[idx:idx + 1]), str(idx)))
+      if depth == 0:
+        if idx > len(data):
+          raise DecodingError('Unexpected End of File at index position of {0}.'.format(str(len(data))))
+        return idx
+
+# --- Bencoder ----------------------------------------------------------------
+# Encodes int, bytes, str (as UTF-8), list, tuple and dict values. Dictionary
+# keys are sorted by their raw bytes as bencoding requires. Parts are
+# collected in a list and joined once.
+class Encoder:
+  def __init__(self):
+    self.part_list = []
+
+  def encode(self, value) -> bytes:
+    """Returns the bencoded value."""
+    self.part_list = []
+    self.__encode_value(value)
+    data = b''.join(self.part_list)
+    self.part_list = []
+    return data
+
+  def __encode_value(self, value):
+    parts = self.part_list
+    if isinstance(value, int):
+      parts.append(b'i%de' % value)
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+      value = bytes(value)
+      parts.append(b'%d:' % len(value))
+      parts.append(value)
+    elif isinstance(value, str):
+      self.__encode_value(value.encode('utf-8'))
+    elif isinstance(value, (list, tuple)):
+      parts.append(b'l')
+      for element in value:
+        self.__encode_value(element)
+      parts.append(b'e')
+    elif isinstance(value, dict):
+      key_list = []
+      for key, element in value.items():
+        if isinstance(key, str):
+          key = key.encode('utf-8')
+        elif not isinstance(key, bytes):
+          raise EncodingError('Invalid dictionary key type {0}.'.format(type(key).__name__))
+        key_list.append((key, element))
+      key_list.sort(key=lambda key_element: key_element[0])
+      parts.append(b'd')
+      for key, element in key_list:
+        self.__encode_value(key)
+        self.__encode_value(element)
+      parts.append(b'e')
+    else:
+      raise EncodingError('Cannot bencode values of type {0}.'.format(type(value).__name__))
+
+# --- Piece hashes -------------------------------------------------------------
+# SHA1 hashes of the pieces kept in the single buffer of the torrent pieces
+# string. Indexing returns a 20 bytes memoryview that compares equal to the
+# bytes digest of the piece.
+class PieceHashList:
+  def __init__(self, pieces):
+    self.pieces = memoryview(pieces)
+
+  def __len__(self):
+    return len(self.pieces) // 20
+
+  def __getitem__(self, piece_idx):
+    if piece_idx < 0 or piece_idx >= len(self):
+      raise IndexError('piece index out of range')
+    start = piece_idx * 20
+    return self.pieces[start:start + 20]
+
+# --- Open file cache ---------------------------------------------------------
+# Bounded LRU cache of open file descriptors shared by all reader threads.
+# Reads use pread() so threads can share a descriptor without seeking. A
+# descriptor in use is never closed; if all descriptors are in use the cache
+# grows temporarily above its limit.
+class FileHandleCache:
+  def __init__(self, max_open):
+    self.max_open = max_open
+    self.lock = threading.Lock()
+    self.handles = OrderedDict() # path -> [fd, use_count]
+    # Extra flags for os.open(), like O_DIRECT
+    self.extra_open_flags = 0
+    # posix_fadvise() advice given to files when they are opened, if any
+    self.open_advice = None
+    # With --fadvise the page cache residency of a file is taken when it is
+    # opened, before any read or read ahead of this run caches its pages
+    self.track_residency = False
+    self.residency_dict = {} # path -> bytes, see get_range_residency()
+
+  def open_handle(self, path):
+    if self.extra_open_flags:
+      try:
+        return os.open(path, os.O_RDONLY | self.extra_open_flags)
+      except OSError:
+        # Filesystem does not support the flags (O_DIRECT on tmpfs)
+        pass
+    fd = os.open(path, os.O_RDONLY)
+    if self.open_advice is not None:
+      os.posix_fadvise(fd, 0, 0, self.open_advice)
+    return fd
+
+  def close_handle(self, fd):
+    os.close(fd)
+
+  def acquire(self, path):
+    """Returns an open descriptor for path. Must be released with release()."""
+    with self.lock:
+      entry = self.handles.get(path)
+      if entry is not None:
+        self.handles.move_to_end(path)
+        entry[1] += 1
+        return entry[0]
+    start_time = time.perf_counter()
+    handle = self.open_handle(path)
+    add_run_time('open', start_time)
+    if self.track_residency:
+      resident_pages = get_range_residency(handle, 0, os.fstat(handle).st_size)
+    with self.lock:
+      entry = self.handles.get(path)
+      if entry is not None:
+        # Another thread opened it meanwhile
+        self.close_handle(handle)
+        entry[1] += 1
+        return entry[0]
+      self.handles[path] = [handle, 1]
+      if self.track_residency:
+        self.residency_dict[path] = resident_pages
+      self.__evict()
+    return handle
+
+  def get_resident_pages(self, path, file_start, file_end):
+    """Returns the residency of the pages of [file_start, file_end) when
+    path was opened, as get_range_residency(), or None if not known."""
+    with self.lock:
+      resident_pages = self.residency_dict.get(path)
+    if resident_pages is None:
+      return None
+    page_size = mmap.PAGESIZE
+
+    return resident_pages[file_start // page_size:-(-file_end // page_size)]
+
+  def release(self, path):
+    with self.lock:
+      self.handles[path][1] -= 1
+      self.__evict()
+
+  def close_all(self):
+    with self.lock:
+      for path in list(self.handles):
+        handle, use_count = self.handles[path]
+        if use_count == 0:
+          self.close_handle(handle)
+          del self.handles[path]
+          self.residency_dict.pop(path, None)
+
+  def __evict(self):
+    if len(self.handles) <= self.max_open:
+      return
+    for path in list(self.handles):
+      handle, use_count = self.handles[path]
+      if use_count == 0:
+        self.close_handle(handle)
+        del self.handles[path]
+        self.residency_dict.pop(path, None)
+        if len(self.handles) <= self.max_open:
+          return
+
+# Same as FileHandleCache but keeps read-only memory mappings of whole files.
+# Each file is mapped once and pieces are hashed from slices of the mapping.
+class MmapCache(FileHandleCache):
+  def open_handle(self, path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+      mapping = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    finally:
+      os.close(fd)
+    if hasattr(mapping, 'madvise'):
+      mapping.madvise(mmap.MADV_SEQUENTIAL)
+    return mapping
+
+  def close_handle(self, mapping):
+    mapping.close()
+
+# Reads into buffer from fd at offset. Returns the number of bytes read.
+# Replaced by timed_pread_into() with --stats.
+if hasattr(os, 'preadv'):
+  def pread_into(fd, buffer, offset):
+    return os.preadv(fd, [buffer], offset)
+else:
+  def pread_into(fd, buffer, offset):
+    data = os.pread(fd, len(buffer), offset)
+    buffer[:len(data)] = data
+    return len(data)
+untimed_pread_into = pread_into
+
+# --- Run statistics ---
+# With --stats the time spent in stat, open, read, hash and output is added
+# up (over all threads, so it can exceed the wall time) together with the
+# bytes read, the number and bytes of the pieces checked and the time spent
+# reading and hashing every file. With --mmap reading happens in page faults
+# while hashing, so it is counted as hash time and the mapped bytes hashed as
+# bytes read. The throughput is based on the bytes checked, so pieces from
+# the verification cache count too.
+class RunStats:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.start_time = time.perf_counter()
+    self.time_dict = OrderedDict((category, 0.0) for category in ('stat', 'open', 'read', 'hash', 'output'))
+    self.bytes_read = 0
+    self.num_pieces = 0
+    self.bytes_checked = 0
+    self.file_time_dict = {} # (torrent, file_idx) -> seconds
+
+  def add_time(self, category, seconds):
+    with self.lock:
+      self.time_dict[category] += seconds
+
+  def add_read(self, num_bytes, seconds):
+    with self.lock:
+      self.time_dict['read'] += seconds
+      self.bytes_read += num_bytes
+
+  def add_pieces(self, num_pieces, num_bytes):
+    with self.lock:
+      self.num_pieces += num_pieces
+      self.bytes_checked += num_bytes
+
+  def add_file_time(self, file_key, seconds):
+    with self.lock:
+      self.file_time_dict[file_key] = self.file_time_dict.get(file_key, 0.0) + seconds
+
+__run_stats = None
+
+# Adds the time since start_time to a category if --stats is used
+def add_run_time(category, start_time):
+  if __run_stats is not None:
+    __run_stats.add_time(category, time.perf_counter() - start_time)
+
+# Used instead of pread_into() with --stats
+def timed_pread_into(fd, buffer, offset):
+  start_time = time.perf_counter()
+  num_read = untimed_pread_into(fd, buffer, offset)
+  __run_stats.add_read(num_read, time.perf_counter() - start_time)
+
+  return num_read
+
+# hashlib hasher that adds the time spent hashing to the run statistics
+class TimedHasher:
+  def __init__(self, run_stats):
+    self.hasher = hashlib.sha1()
+    self.run_stats = run_stats
+
+  def update(self, data):
+    start_time = time.perf_counter()
+    self.hasher.update(data)
+    self.run_stats.add_time('hash', time.perf_counter() - start_time)
+
+  def digest(self):
+    return self.hasher.digest()
+
+def new_piece_hasher():
+  if __run_stats is not None:
+    return TimedHasher(__run_stats)
+
+  return hashlib.sha1()
+
+# Returns the value at percent of a sorted list
+def get_percentile(sorted_list, percent):
+  if not sorted_list:
+    return 0.0
+  idx = min(len(sorted_list) - 1, int(len(sorted_list) * percent / 100))
+
+  return sorted_list[idx]
+
+def print_run_stats(run_stats):
+  wall_time = time.perf_counter() - run_stats.start_time
+  print('')
+  print('Wall time           : {0:12.3f} s'.format(wall_time))
+  for category, seconds in run_stats.time_dict.items():
+    print('Time in {0:12}: {1:12.3f} s'.format(category, seconds))
+  print('Bytes read          : {0:12,}'.format(run_stats.bytes_read))
+  print('Bytes checked       : {0:12,}'.format(run_stats.bytes_checked))
+  if wall_time > 0:
+    print('Check throughput    : {0:12.1f} MB/s'.format(run_stats.bytes_checked / wall_time / 1e6))
+    print('Pieces checked      : {0:12,} ({1:,.1f} pieces/s)'.format(run_stats.num_pieces, run_stats.num_pieces / wall_time))
+  file_time_list = sorted(run_stats.file_time_dict.values())
+  if file_time_list:
+    print('File latency        : p50 {0:.4f} s, p90 {1:.4f} s, p99 {2:.4f} s, max {3:.4f} s ({4:,} files)'
+      .format(get_percentile(file_time_list, 50), get_percentile(file_time_list, 90),
+              get_percentile(file_time_list, 99), file_time_list[-1], len(file_time_list)))
+
+# Live progress line written to standard error with --progress. The ETA is
+# based on the number of bytes of the pieces checked so far.
+class ProgressLine:
+  def __init__(self, total_bytes, update_interval = 0.5):
+    self.total_bytes = total_bytes
+    self.update_interval = update_interval
+    self.start_time = time.perf_counter()
+    self.last_update = 0.0
+    self.done_bytes = 0
+    self.num_pieces = 0
+
+  def update(self, num_bytes):
+    self.done_bytes += num_bytes
+    self.num_pieces += 1
+    now = time.perf_counter()
+    if now - self.last_update >= self.update_interval:
+      self.last_update = now
+      self.write(now)
+
+  def write(self, now):
+    elapsed = max(now - self.start_time, 1e-6)
+    rate = self.done_bytes / elapsed
+    percent = 100.0 * self.done_bytes / self.total_bytes if self.total_bytes else 100.0
+    eta = (self.total_bytes - self.done_bytes) / rate if rate > 0 else 0
+    sys.stderr.write('\r{0:5.1f}% {1:,} pieces {2:8.1f} MB/s ETA {3:d}:{4:02d}:{5:02d} '
+      .format(percent, self.num_pieces, rate / 1e6, int(eta) // 3600, int(eta) // 60 % 60, int(eta) % 60))
+    sys.stderr.flush()
+
+  def finish(self):
+    self.write(time.perf_counter())
+    sys.stderr.write('\n')
+    sys.stderr.flush()
 
 # --- Functions ---------------------------------------------------------------
 def query_yes_no_all(question, default="no"):
@@ -214,6 +706,16 @@ def confirm_file_action(action_str, result_str, force_delete):
 
   return (delete_file, force_delete)
 
+# Asks before deleting a directory tree. Only an explicit yes deletes it.
+def confirm_directory_delete(path):
+  sys.stdout.write('Delete directory {0} and ALL its contents? [y/N] '.format(path))
+  if input().lower() in ('y', 'yes'):
+    print('Directory deleted')
+    return True
+  print('Directory not deleted')
+
+  return False
+
 # If max_length == -1 it means size of terminal could not be determined. Do
 # nothing witht the string.
 def limit_string_lentgh(string, max_length):
@@ -230,20 +732,70 @@ def join_file_byte_list(file_list_bytes):
 
   return '/'.join(file_list_string)
 
+# Returns a list of (path tuple, file properties) of a BEP 52 file tree.
+# File nodes have an empty key with the file properties.
+def get_v2_file_tree_list(file_tree, path=()):
+  file_tree_list = []
+  for name, node in file_tree.items():
+    if b'' in node:
+      file_tree_list.append((path + (name,), node[b'']))
+    else:
+      file_tree_list.extend(get_v2_file_tree_list(node, path + (name,)))
+
+  return file_tree_list
+
+# Fills the list of files of a v2 only torrent
+def extract_v2_file_list(torrent, info_ordered_dict):
+  t_name = info_ordered_dict[b'name']
+  file_tree_list = get_v2_file_tree_list(info_ordered_dict[b'file tree'])
+  torrent.piece_length = info_ordered_dict[b'piece length']
+  torrent.num_pieces = 0
+  torrent.pieces_hash_list = PieceHashList(b'')
+  # A single file torrent has one file named like the torrent, stored
+  # directly in the download directory
+  if len(file_tree_list) != 1 or file_tree_list[0][0] != (t_name,):
+    torrent.dir_name = t_name.decode('utf-8')
+  torrent.num_files = len(file_tree_list)
+  torrent.total_bytes = 0
+  for path, file_properties in file_tree_list:
+    torrent.file_name_list.append(join_file_byte_list(path))
+    torrent.file_length_list.append(file_properties[b'length'])
+    torrent.total_bytes += file_properties[b'length']
+
+# Gets the pieces root of every file and the piece layers. Files of the
+# file tree are found in the list of files by name, so in hybrid torrents
+# they are matched to the v1 files (pad files are not in the file tree).
+def load_v2_metadata(torrent, info_ordered_dict, torr_ordered_dict):
+  torrent.piece_layers = torr_ordered_dict.get(b'piece layers', {})
+  file_index_dict = get_file_index_dict(torrent)
+  for path, file_properties in get_v2_file_tree_list(info_ordered_dict[b'file tree']):
+    if file_properties[b'length'] > 0:
+      file_idx = file_index_dict[join_file_byte_list(path)]
+      torrent.v2_file_dict[file_idx] = bytes(file_properties[b'pieces root'])
+
 # Returns a Torrent object with torrent metadata
 __debug_torrent_extract_metadata = 0
-def extract_torrent_metadata(filename):
-  torrent = Torrent
+def extract_torrent_metadata(filename, quiet=False):
+  torrent = Torrent()
   torrent.torrent_file = filename
   
-  sys.stdout.write('Bdecoding torrent file {0}... '.format(torrentFileName))
-  sys.stdout.flush()
-  torrent_file = open(torrentFileName, "rb")
-  # Use internal Bdecoder class
-  decoder = Decoder(torrent_file.read())
+  if not quiet:
+    sys.stdout.write('Bdecoding torrent file {0}... '.format(filename))
+    sys.stdout.flush()
+  torrent_file = open(filename, "rb")
+  # Use internal Bdecoder class. Piece hashes are not copied and the files
+  # are decoded one at a time while the file list is filled.
+  decoder = Decoder(torrent_file.read(), lazy_keys=(b'pieces', b'files'))
+  torrent_file.close()
   torr_ordered_dict = decoder.decode()
   info_ordered_dict = torr_ordered_dict[b'info']
-  sys.stdout.write('done\n')
+  info_start, info_end = decoder.root_value_spans[b'info']
+  torrent.info_hash = hashlib.sha1(decoder.data[info_start:info_end]).hexdigest()
+  if info_ordered_dict.get(b'meta version') == 2:
+    torrent.meta_version = 2
+    torrent.info_hash_v2 = hashlib.sha256(decoder.data[info_start:info_end]).hexdigest()
+  if not quiet:
+    sys.stdout.write('done\n')
 
   if __debug_torrent_extract_metadata:
     print('=== Dumping torrent root ===')
@@ -254,20 +806,22 @@ def extract_torrent_metadata(filename):
     for key in info_ordered_dict:
       print(' key {0} value {1}'.format(key, info_ordered_dict[key]))
 
+  # v2 only torrent: files are in the file tree and there are no v1 pieces
+  if b'pieces' not in info_ordered_dict and torrent.meta_version == 2:
+    extract_v2_file_list(torrent, info_ordered_dict)
+
   # If torrent info has files field then torrent has several files
-  if b'files' in info_ordered_dict:
+  elif b'files' in info_ordered_dict:
     t_name = info_ordered_dict[b'name'] # Directory name to store torrent
     t_piece_length = info_ordered_dict[b'piece length']
     t_files_list = info_ordered_dict[b'files']
     
-    # --- Converts the string into a file-like object
+    # --- Piece hashes are a view over the decoded pieces string
     t_pieces = info_ordered_dict[b'pieces']
-    pieces = io.BytesIO(t_pieces)
     # --- Ensure num_pieces is integer
     num_pieces = len(t_pieces) / 20
     if not num_pieces.is_integer():
-      print('num_pieces {0} is not integer!'.format(num_pieces))
-      sys.exit(1)
+      raise DecodingError('num_pieces {0} is not integer!'.format(num_pieces))
     num_pieces = int(num_pieces)
 
     # --- Fill torrent object
@@ -275,15 +829,15 @@ def extract_torrent_metadata(filename):
     torrent.piece_length = t_piece_length
     torrent.num_pieces = num_pieces
     torrent.num_files = len(t_files_list)
-    for i in range(num_pieces):
-      hash = pieces.read(20)
-      torrent.pieces_hash_list.append(hash)
+    torrent.pieces_hash_list = PieceHashList(t_pieces)
     torrent.total_bytes = 0
     for t_file in t_files_list:
       torrent.file_name_list.append(join_file_byte_list(t_file[b'path']))
       # print(type(t_file[b'length'])) # type is <class 'int'>
       torrent.file_length_list.append(t_file[b'length'])
       torrent.total_bytes += t_file[b'length']
+      if b'p' in t_file.get(b'attr', b''):
+        torrent.pad_file_set.add(len(torrent.file_name_list) - 1)
 
     # DEBUG
     if __debug_torrent_extract_metadata:
@@ -301,14 +855,12 @@ def extract_torrent_metadata(filename):
     t_piece_length = info_ordered_dict[b'piece length']
     t_length = info_ordered_dict[b'length']
     
-    # --- Converts the string into a file-like object
+    # --- Piece hashes are a view over the decoded pieces string
     t_pieces = info_ordered_dict[b'pieces']
-    pieces = io.BytesIO(t_pieces)
     # --- Ensure num_pieces is integer
     num_pieces = len(t_pieces) / 20
     if not num_pieces.is_integer():
-      print('num_pieces {0} is not integer!'.format(num_pieces))
-      sys.exit(1)
+      raise DecodingError('num_pieces {0} is not integer!'.format(num_pieces))
     num_pieces = int(num_pieces)
 
     # --- Fill torrent object
@@ -317,9 +869,7 @@ def extract_torrent_metadata(filename):
     torrent.num_files = 1
     torrent.file_name_list.append(t_name.decode("UTF-8"))
     torrent.file_length_list.append(t_length)
-    for i in range(num_pieces):
-      hash = pieces.read(20)
-      torrent.pieces_hash_list.append(hash)
+    torrent.pieces_hash_list = PieceHashList(t_pieces)
     torrent.total_bytes = t_length
 
     # DEBUG
@@ -333,66 +883,95 @@ def extract_torrent_metadata(filename):
       print(' num_pieces * piece_length = {0}'.format(num_pieces * t_piece_length))
       print(' len(torrent.pieces_hash_list) = {0}'.format(len(torrent.pieces_hash_list)))
 
-  # Make a list of files for each piece. Should include also the file offsets.
-  # This is to find torrent that has padded files that must be trimmend.
-  # Many Linux torrent clients have this bug in ext4 filesystems.
-  # [ [{'file_idx': 0, 'start_offset': 1234, 'end_offset': 5678},
-  #    { ... } ],
-  #   [  ...   ],
-  #   ...
-  # ]
-  piece_length = torrent.piece_length
-  pieces_file_list = []
-  piece_current_length = 0
-  this_piece_files_list = []
-  for i in range(torrent.num_files):
-    file_dict = {}
-    file_dict['file_idx'] = i
-    file_dict['start_offset'] = 0
-    file_size = file_current_size = torrent.file_length_list[i]
-    while True:
-      remaining_piece_bytes = piece_length - piece_current_length
-      if file_current_size > remaining_piece_bytes:
-        piece_current_length += remaining_piece_bytes
-        file_current_size -= remaining_piece_bytes
-      else:
-        piece_current_length += file_current_size
-        file_current_size = 0
-      # Go for next file if no more bytes
-      if file_current_size == 0:
-        file_dict['end_offset'] = file_size
-        this_piece_files_list.append(file_dict)
-        break
-      # Piece is ready, add to the list
-      file_dict['end_offset'] = file_size - file_current_size
-      this_piece_files_list.append(file_dict)
-      pieces_file_list.append(this_piece_files_list)
-      # Reset piece files list and size
-      piece_current_length = 0
-      this_piece_files_list = []
-      # Add current file to piece files list
-      file_dict = {}
-      file_dict['file_idx'] = i
-      file_dict['start_offset'] = file_size - file_current_size
-  # Last piece
-  if piece_current_length > 0:
-    pieces_file_list.append(this_piece_files_list)
-    
+  # Make an array with the offset of each file in the torrent data. File i
+  # spans bytes [file_offset_list[i], file_offset_list[i+1]) of the torrent
+  # data. The files of a piece and the pieces of a file are found by
+  # bisection, so memory grows with the number of files and not with the
+  # number of pieces. This is to find torrent that has padded files that
+  # must be trimmend. Many Linux torrent clients have this bug in ext4
+  # filesystems.
+  file_offset_list = array('Q', [0])
+  for file_length in torrent.file_length_list:
+    file_offset_list.append(file_offset_list[-1] + file_length)
+
   # Put in torrent object
-  torrent.pieces_file_list = pieces_file_list
+  torrent.file_offset_list = file_offset_list
+
+  # v2 and hybrid torrents: per file Merkle roots
+  if torrent.meta_version == 2:
+    load_v2_metadata(torrent, info_ordered_dict, torr_ordered_dict)
 
   # DEBUG: print list of files per piece
   if __debug_torrent_extract_metadata:
-    for piece_idx in range(len(pieces_file_list)):
+    for piece_idx in range(torrent.num_pieces):
       print('Piece {0:06d}'.format(piece_idx))
-      this_piece_files_list = pieces_file_list[piece_idx]
-      for file_idx in range(len(this_piece_files_list)):
-        file_dict = this_piece_files_list[file_idx]
+      for file_idx, start_offset, end_offset in get_piece_files(torrent, piece_idx):
         print(' File {0:06d} start {1:8d} end {2:8d}'
-          .format(file_dict['file_idx'], file_dict['start_offset'], file_dict['end_offset']))
+          .format(file_idx, start_offset, end_offset))
 
   return torrent
 
+# Sets the torrent download and data directories. Data directory is the
+# download directory plus the torrent internal directory, unless --otd is
+# used or the torrent has a single file.
+def set_torrent_data_directory(torrent, data_directory):
+  torrent.dir_download = data_directory
+  # User wants to override torrent data directory
+  if __prog_options_override_torrent_dir or torrent.dir_name is None:
+    torrent.dir_data = torrent.dir_download
+  # Normal mode of operation
+  else:
+    torrent.dir_data = os.path.join(data_directory, torrent.dir_name)
+
+# Returns the size of a piece, the last one can be shorter
+def get_piece_size(torrent, piece_idx):
+  return min(torrent.piece_length, torrent.total_bytes - piece_idx * torrent.piece_length)
+
+# Returns the list of files a piece spans as (file_idx, start_offset,
+# end_offset) tuples. Offsets are relative to the start of the file. Empty
+# files are listed in the piece where they start.
+def get_piece_files(torrent, piece_idx):
+  file_offset_list = torrent.file_offset_list
+  num_files = torrent.num_files
+  piece_start = piece_idx * torrent.piece_length
+  piece_end = min(piece_start + torrent.piece_length, file_offset_list[num_files])
+  # First file starting at piece_start, or the one containing it
+  first_idx = bisect_left(file_offset_list, piece_start, 0, num_files)
+  if first_idx == num_files or file_offset_list[first_idx] > piece_start:
+    first_idx -= 1
+  # Last file starting before piece_end. Last piece also gets empty files
+  # at the end of the torrent.
+  if piece_idx == torrent.num_pieces - 1:
+    last_idx = num_files - 1
+  else:
+    last_idx = bisect_left(file_offset_list, piece_end, 0, num_files) - 1
+
+  piece_files_list = []
+  for file_idx in range(first_idx, last_idx + 1):
+    file_start = file_offset_list[file_idx]
+    file_end = file_offset_list[file_idx + 1]
+    piece_files_list.append((file_idx, max(piece_start, file_start) - file_start,
+                             min(piece_end, file_end) - file_start))
+
+  return piece_files_list
+
+# Returns the range of pieces a file spans. Empty files span the piece where
+# they start.
+def get_file_pieces(torrent, file_idx):
+  if torrent.num_pieces == 0:
+    return range(0)
+  file_start = torrent.file_offset_list[file_idx]
+  file_end = torrent.file_offset_list[file_idx + 1]
+  first_piece = file_start // torrent.piece_length
+  if file_end > file_start:
+    last_piece = (file_end - 1) // torrent.piece_length
+  else:
+    last_piece = first_piece
+  last_piece = min(last_piece, torrent.num_pieces - 1)
+  first_piece = min(first_piece, last_piece)
+
+  return range(first_piece, last_piece + 1)
+
 def list_torrent_contents(torrent):
   print('Printing torrent file contents...')
 
@@ -413,9 +992,142 @@ def list_torrent_contents(torrent):
     .format(torrent.num_files, torrent.total_bytes))
   if torrent.num_files > 1:
     print('Torrent directory : {0}'.format(torrent.dir_name))
+  if torrent.pad_file_set:
+    print('Pad files         : {0:10,}'.format(len(torrent.pad_file_set)))
+  if torrent.meta_version == 2:
+    print('Meta version      : 2 ({0})'.format('hybrid' if torrent.num_pieces else 'v2 only'))
 
   return 0
 
+# Status of a downloaded file, taken with a single stat() call.
+# exists is False if file does not exist or is not a regular file. In that
+# case the rest of fields are -1.
+FileStat = namedtuple('FileStat', ['exists', 'size', 'mtime_ns', 'inode', 'dev'])
+__missing_file_stat = FileStat(False, -1, -1, -1, -1)
+
+def stat_file(path):
+  try:
+    st = os.stat(path)
+  except OSError:
+    return __missing_file_stat
+
+  return get_file_stat(st)
+
+def get_file_stat(st):
+  if not stat.S_ISREG(st.st_mode):
+    return __missing_file_stat
+
+  return FileStat(True, st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev)
+
+# --- Stat engine ---
+# Files are grouped by directory and every directory is listed once with
+# os.scandir() and every listed file gets a single stat() call. A name not in
+# the listing is stat'ed once more by itself because it may differ in case or
+# Unicode normalization on case-insensitive filesystems (SMB, macOS), so the
+# result does not depend on --statJobs. That only costs a round trip for
+# missing files. Directories are listed and files are stat'ed by --statJobs
+# threads, which is the number of requests in flight and matters on network
+# filesystems where every call waits a round trip. Files are stat'ed in
+# chunks so a flat torrent with all files in the same directory is also
+# stat'ed in parallel.
+__stat_chunk_size = 256
+
+# Returns a dictionary of name -> DirEntry of a directory, or None if the
+# directory cannot be listed.
+def scan_directory(directory):
+  try:
+    with os.scandir(directory) as it:
+      return {entry.name : entry for entry in it}
+  except OSError:
+    return None
+
+# file_list is a list of (file_idx, directory, name, entry) tuples. Returns
+# a list of (file_idx, FileStat).
+def stat_file_chunk(file_list):
+  result_list = []
+  for file_idx, directory, name, entry in file_list:
+    try:
+      # DirEntry.stat() follows symlinks like os.stat()
+      result_list.append((file_idx, get_file_stat(entry.stat())))
+    except OSError:
+      result_list.append((file_idx, __missing_file_stat))
+
+  return result_list
+
+# Stats every torrent file exactly once per run. The snapshot is put in the
+# torrent object and used by the piece reader and the reports. Pad files are
+# not stat'ed.
+# With --readOrder inode or physical files are stat'ed in inode order.
+def take_file_stat_snapshot(torrent):
+  start_time = time.perf_counter()
+  file_stat_list = [__missing_file_stat] * len(torrent.file_name_list)
+  # On local filesystems stat() is so fast that listing directories first
+  # does not pay off, so a single job just stats files in order.
+  if __prog_options_statJobs <= 1 and __prog_options_readOrder == 'logical':
+    for i in range(len(torrent.file_name_list)):
+      if i not in torrent.pad_file_set:
+        file_stat_list[i] = stat_file(torrent_file_path(torrent, i))
+    torrent.file_stat_list = file_stat_list
+    add_run_time('stat', start_time)
+    return file_stat_list
+
+  directory_dict = OrderedDict() # directory -> list of (file_idx, name)
+  for i in range(len(torrent.file_name_list)):
+    if i in torrent.pad_file_set:
+      continue
+    directory, name = os.path.split(torrent_file_path(torrent, i))
+    directory_dict.setdefault(directory, []).append((i, name))
+
+  executor = None
+  map_function = map
+  if __prog_options_statJobs > 1:
+    executor = ThreadPoolExecutor(max_workers=__prog_options_statJobs)
+    map_function = executor.map
+  try:
+    stat_list = []
+    for (directory, name_list), entry_dict in zip(directory_dict.items(),
+                                                  map_function(scan_directory, directory_dict)):
+      if entry_dict is None:
+        continue
+      for file_idx, name in name_list:
+        entry = entry_dict.get(name)
+        if entry is not None:
+          stat_list.append((file_idx, directory, name, entry))
+        else:
+          # Not listed. Name may differ in case or Unicode normalization,
+          # so ask the filesystem.
+          file_stat_list[file_idx] = stat_file(os.path.join(directory, name))
+    if __prog_options_readOrder != 'logical':
+      stat_list.sort(key=lambda file_info: file_info[3].inode())
+    chunk_list = [stat_list[i:i + __stat_chunk_size] for i in range(0, len(stat_list), __stat_chunk_size)]
+    for result_list in map_function(stat_file_chunk, chunk_list):
+      for file_idx, file_stat in result_list:
+        file_stat_list[file_idx] = file_stat
+  finally:
+    if executor is not None:
+      executor.shutdown()
+  torrent.file_stat_list = file_stat_list
+  add_run_time('stat', start_time)
+
+  return file_stat_list
+
+def torrent_file_path(torrent, file_idx):
+  return os.path.join(torrent.dir_data, torrent.file_name_list[file_idx])
+
+# Returns (file_status, file_size) of a torrent file from the stat snapshot.
+# Status can be: OK, MISSING, BAD_SIZE, PAD. file_size is -1 if file is
+# missing. Pad files are never on disk, their size is the torrent size.
+def get_file_status(torrent, file_idx):
+  if file_idx in torrent.pad_file_set:
+    return ('PAD', torrent.file_length_list[file_idx])
+  file_stat = torrent.file_stat_list[file_idx]
+  if not file_stat.exists:
+    return ('MISSING', -1)
+  if file_stat.size == torrent.file_length_list[file_idx]:
+    return ('OK', file_stat.size)
+
+  return ('BAD_SIZE', file_stat.size)
+
 # Checks that files listed in the torrent file exist, and that file size
 # is correct
 # Status can be: OK, MISSING, BAD_SIZE
@@ -426,32 +1138,29 @@ def check_torrent_files_only(torrent):
   num_files_bigger_size = 0
   num_files_smaller_size = 0
   num_files_missing = 0
+  num_pad_files = 0
   force_delete = False
   force_truncate = False
   num_deleted_files = 0
   num_truncated_files = 0
+  take_file_stat_snapshot(torrent)
   print('    F#   Status     Actual Bytes    Torrent Bytes  File name')
   print('------ -------- ---------------- ----------------  --------------')
   for i in range(len(torrent.file_name_list)):
-    file_size = -1
-    filename_path = os.path.join(torrent.dir_data, torrent.file_name_list[i])
-    # print(filename_path)
-    file_exists = os.path.isfile(filename_path)
-    if file_exists:
-      file_size = os.path.getsize(filename_path)
-      if file_size == torrent.file_length_list[i]:
-        status = 'OK'
-        num_files_OK += 1
+    filename_path = torrent_file_path(torrent, i)
+    status, file_size = get_file_status(torrent, i)
+    if status == 'OK':
+      num_files_OK += 1
+    elif status == 'PAD':
+      num_pad_files += 1
+    elif status == 'BAD_SIZE':
+      ret_value = 1
+      if file_size > torrent.file_length_list[i]:
+        num_files_bigger_size += 1
       else:
-        ret_value = 1
-        status = 'BAD_SIZE'
-        if file_size > torrent.file_length_list[i]:
-          num_files_bigger_size += 1
-        else:
-          num_files_smaller_size += 1
+        num_files_smaller_size += 1
     else:
       ret_value = 1
-      status = 'MISSING'
       num_files_missing += 1
 
     # --- Print file info
@@ -498,6 +1207,8 @@ def check_torrent_files_only(torrent):
   print('Files w big size   : {0:,}'.format(num_files_bigger_size))
   print('Files w small size : {0:,}'.format(num_files_smaller_size))
   print('Files missing      : {0:,}'.format(num_files_missing))
+  if num_pad_files:
+    print('Pad files          : {0:,}'.format(num_pad_files))
   if __prog_options_deleteWrongSizeFiles:
     print('Deleted files      : {0:,}'.format(num_deleted_files))
   if __prog_options_truncateWrongSizeFiles:
@@ -517,59 +1228,180 @@ def check_torrent_files_only(torrent):
 
   return ret_value
 
+# --- Unneeded files ---
+# The data directory is scanned with os.scandir() one directory at a time and
+# every entry is looked up by relative path in an index of the torrent files
+# and directories. Directories the torrent does not contain are reported as a
+# single unneeded entry and not descended into, unless --unneededSizes asks
+# for their size. With --statJobs directories are scanned in parallel. Only
+# unneeded entries are kept and reported.
+
+# Returns a dictionary of relative directory -> {child name : is_dir} of all
+# directories of the torrent. The data directory is ''.
+def get_torrent_directory_index(torrent):
+  directory_index = {'' : {}}
+  for file_name in torrent.file_name_list:
+    parts = file_name.split('/')
+    directory = ''
+    for k in range(len(parts)):
+      is_dir = k < len(parts) - 1
+      children = directory_index.setdefault(directory, {})
+      # A name that is a file in one place and a directory in another is
+      # kept as directory
+      children[parts[k]] = children.get(parts[k], False) or is_dir
+      directory = parts[k] if directory == '' else directory + '/' + parts[k]
+
+  return directory_index
+
+# Returns (num_files, num_bytes) of a directory tree. Symlinks are not
+# followed.
+def get_tree_size(path):
+  num_files = num_bytes = 0
+  try:
+    with os.scandir(path) as it:
+      for entry in it:
+        try:
+          if entry.is_dir(follow_symlinks=False):
+            tree_files, tree_bytes = get_tree_size(entry.path)
+            num_files += tree_files
+            num_bytes += tree_bytes
+          else:
+            num_files += 1
+            num_bytes += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+          pass
+  except OSError:
+    pass
+
+  return (num_files, num_bytes)
+
+# Scans a directory of the data directory. Returns (unneeded_list,
+# subdirectory_list, num_needed) where unneeded_list has (relative path,
+# is_dir, num_files, num_bytes) tuples and subdirectory_list the relative
+# paths of the torrent subdirectories found. Symlinks to directories match
+# torrent directories but are not descended into. Unneeded symlinks are
+# reported as files so deleting them removes only the link.
+def scan_unneeded_directory(dir_data, directory, children, compute_sizes):
+  unneeded_list = []
+  subdirectory_list = []
+  num_needed = 0
+  try:
+    it = os.scandir(os.path.join(dir_data, directory) if directory else dir_data)
+  except OSError:
+    return (unneeded_list, subdirectory_list, num_needed)
+  with it:
+    for entry in it:
+      relative_path = entry.name if directory == '' else directory + '/' + entry.name
+      try:
+        entry_is_dir = entry.is_dir()
+        entry_is_link = entry.is_symlink()
+      except OSError:
+        entry_is_dir = entry_is_link = False
+      if entry.name in children and children[entry.name] == entry_is_dir:
+        if not entry_is_dir:
+          num_needed += 1
+        elif not entry_is_link:
+          subdirectory_list.append(relative_path)
+        continue
+      if entry_is_link:
+        entry_is_dir = False
+      num_files = num_bytes = 0
+      if compute_sizes:
+        if entry_is_dir:
+          num_files, num_bytes = get_tree_size(entry.path)
+        else:
+          try:
+            num_files, num_bytes = 1, entry.stat(follow_symlinks=False).st_size
+          except OSError:
+            pass
+      unneeded_list.append((relative_path, entry_is_dir, num_files, num_bytes))
+
+  return (unneeded_list, subdirectory_list, num_needed)
+
+# Returns (unneeded_list, num_needed) of the whole data directory
+def scan_unneeded_entries(torrent, compute_sizes):
+  directory_index = get_torrent_directory_index(torrent)
+  unneeded_list = []
+  num_needed = 0
+  if __prog_options_statJobs <= 1:
+    pending_directories = ['']
+    while pending_directories:
+      directory = pending_directories.pop()
+      dir_unneeded_list, subdirectory_list, dir_num_needed = scan_unneeded_directory(
+        torrent.dir_data, directory, directory_index[directory], compute_sizes)
+      unneeded_list.extend(dir_unneeded_list)
+      pending_directories.extend(subdirectory_list)
+      num_needed += dir_num_needed
+    return (unneeded_list, num_needed)
+
+  with ThreadPoolExecutor(max_workers=__prog_options_statJobs) as executor:
+    pending = set([executor.submit(scan_unneeded_directory, torrent.dir_data, '', directory_index[''], compute_sizes)])
+    while pending:
+      done, pending = wait(pending, return_when=FIRST_COMPLETED)
+      for future in done:
+        dir_unneeded_list, subdirectory_list, dir_num_needed = future.result()
+        unneeded_list.extend(dir_unneeded_list)
+        num_needed += dir_num_needed
+        for directory in subdirectory_list:
+          pending.add(executor.submit(scan_unneeded_directory, torrent.dir_data, directory,
+                                      directory_index[directory], compute_sizes))
+
+  return (unneeded_list, num_needed)
+
 # Lists torrent unneeded files
 def check_torrent_unneeded_files(torrent):
   print('Checking torrent unneeded files')
   ret_value = 0
-
-  # --- Make a recursive list of files in torrent data directory
-  torrent_directory = os.path.join(torrent.dir_data)
-  file_list = []
-  for root, dirs, files in os.walk(torrent_directory, topdown=False):
-    for name in files:
-      file_list.append(os.path.join(root, name))
-
-  # --- Make a set of files in the list of torrent metadata files
-  print('  Status                                File name')
-  print('--------  ---------------------------------------')
-  torrent_file_list = []
-  for i in range(len(torrent.file_name_list)):
-    filename_path = os.path.join(torrent.dir_data, torrent.file_name_list[i])
-    torrent_file_list.append(filename_path);
-  torrent_file_set = set(torrent_file_list)
-
-  # Check number of elements in list and set are the same. This means there are no
-  # duplicate files in the list
-  if len(torrent_file_list) != len(torrent_file_set):
-    print('len(torrent_file_list) != len(torrent_file_set)')
-    exit(1)
-
-  # --- Check if files in the torrent directory are on the metadata file set
-  num_needed = 0
-  num_redundant = 0
+  compute_sizes = __prog_options_unneededSizes
+  unneeded_list, num_needed = scan_unneeded_entries(torrent, compute_sizes)
+  unneeded_list.sort()
+
+  # --- Report unneeded files and directories
+  if compute_sizes:
+    print('  Status            Bytes  File name')
+    print('--------  ---------------  ---------------------------------------')
+  else:
+    print('  Status                                File name')
+    print('--------  ---------------------------------------')
+  num_unneeded_files = 0
+  num_unneeded_dirs = 0
+  unneeded_bytes = 0
   num_deleted_files = 0
   force_delete = False
   text_size = 10
-  for i in range(len(file_list)):
-    if file_list[i] not in torrent_file_set:
-      print('UNNEEDED  {0}'.format(limit_string_lentgh(file_list[i], __cols -text_size)))
-      ret_value = 1
-      num_redundant += 1
-      
-      # --- Deleted unneeded file
-      if __prog_options_deleteUnneeded:
-        print('      RM  {0}'.format(limit_string_lentgh(file_list[i], __cols -text_size)))
-        # This option is very dangerous if user writes the wrong directory
-        # Always confirm with user
-        delete_file, force_delete = confirm_file_action('Delete', 'deleted', force_delete)
-        if delete_file:
-          os.unlink(file_list[i])
-          num_deleted_files += 1
+  if compute_sizes:
+    text_size = 10+17
+  for relative_path, is_dir, num_files, num_bytes in unneeded_list:
+    path = os.path.join(torrent.dir_data, relative_path)
+    if is_dir:
+      path += os.sep
+      num_unneeded_dirs += 1
+    else:
+      num_unneeded_files += 1
+    unneeded_bytes += num_bytes
+    ret_value = 1
+    if compute_sizes:
+      print('UNNEEDED  {0:15,}  {1}'.format(num_bytes, limit_string_lentgh(path, __cols -text_size)))
     else:
-      print('      OK  {0}'.format(limit_string_lentgh(file_list[i], __cols -text_size)))
-      num_needed += 1
- 
- 
+      print('UNNEEDED  {0}'.format(limit_string_lentgh(path, __cols -text_size)))
+
+    # --- Deleted unneeded file
+    if __prog_options_deleteUnneeded:
+      print('      RM  {0}'.format(limit_string_lentgh(path, __cols -10)))
+      # This option is very dangerous if user writes the wrong directory
+      # Always confirm with user
+      delete_file, force_delete = confirm_file_action('Delete', 'deleted', force_delete)
+      if delete_file:
+        if is_dir:
+          # Whole trees are confirmed one by one, even after answering all
+          if confirm_directory_delete(path):
+            shutil.rmtree(path)
+          else:
+            continue
+        else:
+          os.unlink(path)
+        num_deleted_files += 1
+
   # --- Print torrent metadata
   print('')
   print('Torrent file            : {0}'.format(torrent.torrent_file))
@@ -578,13 +1410,15 @@ def check_torrent_unneeded_files(torrent):
   print('Torrent directory       : {0}'.format(torrent.dir_name))
   print('Download directory      : {0}'.format(torrent.dir_download))
   print('Data directory          : {0}'.format(torrent.dir_data))
-  print('Files in data directory : {0:,}'.format(len(file_list)))
   print('Needed files            : {0:,}'.format(num_needed))
-  print('Unneeded files          : {0:,}'.format(num_redundant))
+  print('Unneeded files          : {0:,}'.format(num_unneeded_files))
+  print('Unneeded directories    : {0:,}'.format(num_unneeded_dirs))
+  if compute_sizes:
+    print('Unneeded bytes          : {0:,}'.format(unneeded_bytes))
   if __prog_options_deleteUnneeded:
     print('Deleted files           : {0:,}'.format(num_deleted_files))
   
-  if num_redundant > 0:
+  if num_unneeded_files > 0 or num_unneeded_dirs > 0:
     print("""WARNING
  Found unneeded files in the torrent download directory.
  Run torrentverify with --checkUnneeded and --deleteUnneeded parameters
@@ -637,125 +1471,1133 @@ def pieces_generator_naive(torrent):
         return
       yield piece
 
-# This piece generator returns zeros if file does not exists. Also,
-# if files are padded at the end does not return that padding. This is to
+# --- Piece reader ---
+# Files are read in blocks of this size into a per-thread buffer that is
+# reused for every read. Blocks are fed into an incremental SHA1 hasher so
+# pieces are never built in memory.
+__read_block_size = 1024 * 1024
+__zero_block = bytes(__read_block_size)
+__thread_local = threading.local()
+__file_handle_cache = FileHandleCache(__max_open_files)
+__mmap_cache = MmapCache(__max_open_files)
+
+def get_read_buffer():
+  read_buffer = getattr(__thread_local, 'read_buffer', None)
+  if read_buffer is None:
+    read_buffer = memoryview(bytearray(__read_block_size))
+    __thread_local.read_buffer = read_buffer
+
+  return read_buffer
+
+# Feeds num_bytes zeros into hasher without allocating them. Hashers with an
+# add_zeros() method (PrefetchFeeder) are just told the number of zeros.
+def feed_zeros(hasher, num_bytes):
+  add_zeros = getattr(hasher, 'add_zeros', None)
+  if add_zeros is not None:
+    add_zeros(num_bytes)
+    return
+  zero_block = memoryview(__zero_block)
+  while num_bytes > 0:
+    block_size = min(num_bytes, __read_block_size)
+    hasher.update(zero_block[:block_size])
+    num_bytes -= block_size
+
+# Feeds bytes [file_start, file_end) of a file into hasher. If the file is
+# shorter than expected the missing bytes are fed as zeros. Hashers with a
+# get_buffer() method (PrefetchFeeder) provide the buffers data is read into,
+# so it is not copied again.
+def feed_file(hasher, path, file_start, file_end):
+  if __prog_options_mmap:
+    feed_file_mmap(hasher, path, file_start, file_end)
+    return
+  remaining = file_end - file_start
+  fd = __file_handle_cache.acquire(path)
+  try:
+    if __prog_options_fadvise:
+      drop_start = max(0, file_start - __drop_lookback)
+      resident_pages = __file_handle_cache.get_resident_pages(path, drop_start, file_end)
+    if __prog_options_directIO:
+      remaining = feed_file_direct(hasher, fd, file_start, file_end)
+    elif hasattr(hasher, 'get_buffer'):
+      offset = file_start
+      while remaining > 0:
+        num_read = pread_into(fd, hasher.get_buffer(remaining), offset)
+        if not num_read:
+          break
+        hasher.buffer_filled(num_read)
+        remaining -= num_read
+        offset += num_read
+    else:
+      read_buffer = get_read_buffer()
+      offset = file_start
+      while remaining > 0:
+        num_read = pread_into(fd, read_buffer[:min(remaining, __read_block_size)], offset)
+        if not num_read:
+          break
+        hasher.update(read_buffer[:num_read])
+        remaining -= num_read
+        offset += num_read
+    # Drop the pages just read so verification does not evict other data
+    # from the page cache. Pages cached before the file was opened are kept.
+    if __prog_options_fadvise:
+      drop_read_pages(fd, drop_start, file_end, resident_pages)
+  finally:
+    __file_handle_cache.release(path)
+  feed_zeros(hasher, remaining)
+
+# Same as feed_file() but hashes straight from a memory mapping of the file.
+# Bytes beyond the end of the mapping are fed as zeros.
+def feed_file_mmap(hasher, path, file_start, file_end):
+  if file_end <= file_start:
+    return
+  mapping = __mmap_cache.acquire(path)
+  try:
+    mapped_end = min(file_end, len(mapping))
+    if mapped_end > file_start:
+      with memoryview(mapping) as mapping_view:
+        hasher.update(mapping_view[file_start:mapped_end])
+      if __run_stats is not None:
+        __run_stats.add_read(mapped_end - file_start, 0.0)
+    else:
+      mapped_end = file_start
+  finally:
+    __mmap_cache.release(path)
+  feed_zeros(hasher, file_end - mapped_end)
+
+# --- Direct I/O ---
+# With --directIO files are opened with O_DIRECT so reads bypass the page
+# cache. O_DIRECT needs buffers, offsets and sizes aligned to the device
+# block size, so whole aligned blocks are read into a page aligned buffer
+# (an anonymous mmap) and only the wanted bytes are fed to the hasher.
+__direct_io_alignment = 4096
+
+def get_direct_buffer():
+  direct_buffer = getattr(__thread_local, 'direct_buffer', None)
+  if direct_buffer is None:
+    size = -(-__read_block_size // __direct_io_alignment) * __direct_io_alignment
+    direct_buffer = memoryview(mmap.mmap(-1, size))
+    __thread_local.direct_buffer = direct_buffer
+
+  return direct_buffer
+
+# Feeds bytes [file_start, file_end) of an open file into hasher using
+# aligned reads. Returns the number of bytes that could not be read.
+def feed_file_direct(hasher, fd, file_start, file_end):
+  direct_buffer = get_direct_buffer()
+  offset = file_start - file_start % __direct_io_alignment
+  skip = file_start - offset
+  remaining = file_end - file_start
+  while remaining > 0:
+    # Read only the aligned blocks holding the wanted bytes
+    read_size = -(-(skip + remaining) // __direct_io_alignment) * __direct_io_alignment
+    read_size = min(read_size, len(direct_buffer))
+    num_read = pread_into(fd, direct_buffer[:read_size], offset)
+    if num_read <= skip:
+      break
+    num_bytes = min(num_read - skip, remaining)
+    hasher.update(direct_buffer[skip:skip + num_bytes])
+    remaining -= num_bytes
+    # A short read means end of file
+    if num_read < read_size:
+      break
+    offset += num_read
+    skip = 0
+
+  return remaining
+
+# --- Page cache residency ---
+# Uses mincore() on a mapping of each file to count how many of its pages
+# are in the page cache. Used by --cacheResidency to measure the effect of a
+# verification pass on the page cache.
+__libc = None
+
+def get_file_cache_residency(path):
+  """Returns (resident_pages, total_pages) of a file."""
+  size = os.path.getsize(path)
+  if size == 0:
+    return (0, 0)
+  page_size = mmap.PAGESIZE
+  num_pages = -(-size // page_size)
+  vec = (ctypes.c_ubyte * num_pages)()
+  with open(path, 'rb') as f:
+    mapping = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_COPY)
+    try:
+      address = ctypes.addressof(ctypes.c_char.from_buffer(mapping))
+      ret = __libc.mincore(ctypes.c_void_p(address), ctypes.c_size_t(size), vec)
+    finally:
+      mapping.close()
+  if ret != 0:
+    return (0, 0)
+
+  return (sum(v & 1 for v in vec), num_pages)
+
+# Maps mincore() vector bytes to 1 for resident pages and 0 for the rest
+__residency_table = bytes(i & 1 for i in range(256))
+
+# Returns a bytes object with 1 for every page of [file_start, file_end) of
+# an open file that is in the page cache, and 0 for the rest. Pages start at
+# the page holding file_start. Returns None if residency is not available.
+def get_range_residency(fd, file_start, file_end):
+  if __libc is None or file_end <= file_start:
+    return None
+  page_size = mmap.PAGESIZE
+  map_start = file_start - file_start % page_size
+  length = file_end - map_start
+  vec = (ctypes.c_ubyte * -(-length // page_size))()
+  try:
+    mapping = mmap.mmap(fd, length, access=mmap.ACCESS_COPY, offset=map_start)
+  except (OSError, ValueError):
+    return None
+  try:
+    address = ctypes.addressof(ctypes.c_char.from_buffer(mapping))
+    ret = __libc.mincore(ctypes.c_void_p(address), ctypes.c_size_t(length), vec)
+  finally:
+    mapping.close()
+  if ret != 0:
+    return None
+
+  return bytes(vec).translate(__residency_table)
+
+# Read ahead caches pages in large folios that can span several pieces, and
+# POSIX_FADV_DONTNEED only drops folios wholly inside its range. So the range
+# dropped after a read also covers this many bytes before it, which drops the
+# folios left partly read by the previous reads of the file.
+__drop_lookback = 2 * 1024 * 1024
+
+# Drops from the page cache the pages of [file_start, file_end) that were
+# not resident before they were read. Drops the whole range if the residency
+# is not known.
+def drop_read_pages(fd, file_start, file_end, resident_pages):
+  if resident_pages is None:
+    os.posix_fadvise(fd, file_start, file_end - file_start, os.POSIX_FADV_DONTNEED)
+    return
+  page_size = mmap.PAGESIZE
+  map_start = file_start - file_start % page_size
+  run_start = resident_pages.find(0)
+  while run_start >= 0:
+    run_end = resident_pages.find(1, run_start)
+    if run_end < 0:
+      run_end = len(resident_pages)
+    os.posix_fadvise(fd, map_start + run_start * page_size, (run_end - run_start) * page_size,
+                     os.POSIX_FADV_DONTNEED)
+    run_start = resident_pages.find(0, run_end)
+
+def get_torrent_cache_residency(torrent):
+  """Returns (resident_pages, total_pages) of all existing torrent files."""
+  resident_pages = total_pages = 0
+  for file_idx in range(torrent.num_files):
+    path = torrent_file_path(torrent, file_idx)
+    if not os.path.isfile(path):
+      continue
+    file_resident, file_total = get_file_cache_residency(path)
+    resident_pages += file_resident
+    total_pages += file_total
+
+  return (resident_pages, total_pages)
+
+def print_cache_residency(title, residency):
+  resident_pages, total_pages = residency
+  percent = 100.0 * resident_pages / total_pages if total_pages else 0.0
+  print('{0}: {1:12,} of {2:12,} pages ({3:5.1f}%)'.format(title, resident_pages, total_pages, percent))
+
+# This piece reader feeds zeros if file does not exists. Also,
+# if files are padded at the end does not feed that padding. This is to
 # mimic KTorrent behaviour: files will pass the SHA checksum of the torrent
 # but some files will have bigger sizes that need to be truncated.
-def pieces_generator(torrent, pieces_list=None):
-  piece_length = torrent.piece_length
+# Returns the list of files the piece spans.
+def feed_piece(torrent, piece_idx, hasher):
+  # Iterate through files of this piece and feed the hasher
+  file_idx_list = []
+  for file_idx, file_start, file_end in get_piece_files(torrent, piece_idx):
+    # Get file info
+    file_name = torrent.file_name_list[file_idx]
+    file_correct_size = torrent.file_length_list[file_idx]
+    file_idx_list.append(file_idx)
+    # Pad files are zeros and are not on disk
+    if file_idx in torrent.pad_file_set:
+      feed_zeros(hasher, file_end - file_start)
+      continue
+    # Read file
+    path = os.path.join(torrent.dir_data, file_name)
+    file_stat = torrent.file_stat_list[file_idx]
+    if file_stat.exists:
+      file_size = file_stat.size
+      if file_size == file_correct_size:
+        # If downloaded file has correct size then read whithin the file
+        # limits. Maybe the whole file if file is smaller than the piece size
+        start_time = time.perf_counter()
+        feed_file(hasher, path, file_start, file_end)
+        if __run_stats is not None:
+          __run_stats.add_file_time((torrent, file_idx), time.perf_counter() - start_time)
+      elif file_size < file_correct_size:
+        # If downloaded file has less size then pad with zeros.
+        # To simplify things, treat file as if it doesn't exist.
+        # Consequently, SHA1 check will fail.
+        feed_zeros(hasher, file_end - file_start)
+      else:
+        # If downloaded file has more size then truncate file read. Note that 
+        # SHA1 check may succed, but file will have an incorrect bigger size 
+        # that must be truncated later.
+        start_time = time.perf_counter()
+        feed_file(hasher, path, file_start, file_end)
+        if __run_stats is not None:
+          __run_stats.add_file_time((torrent, file_idx), time.perf_counter() - start_time)
+    else:
+      # If file does not exists at all, just pad with zeros
+      feed_zeros(hasher, file_end - file_start)
+
+  return file_idx_list
+
+# Reads and hashes a piece. Runs inside the worker threads when --jobs is
+# used. hashlib releases the GIL when hashing large buffers and so does
+# file reading, so threads are enough to use several cores.
+def hash_piece(torrent, piece_idx):
+  # Pieces of pad files and missing files only are all zeros
+  piece_files = get_piece_files(torrent, piece_idx)
+  if is_piece_stopped(torrent, piece_idx):
+    return (None, [piece_file[0] for piece_file in piece_files])
+  if all(is_zero_file(torrent, file_idx) for file_idx, file_start, file_end in piece_files):
+    num_bytes = sum(file_end - file_start for file_idx, file_start, file_end in piece_files)
+    return (get_zero_digest(num_bytes), [piece_file[0] for piece_file in piece_files])
+  hasher = new_piece_hasher()
+  file_idx_list = feed_piece_bounded(torrent, piece_idx, hasher)
+
+  return (hasher.digest(), file_idx_list)
+
+# With --perFileStop a piece is not read once all the files it has data of
+# had a bad piece. hash_piece() returns None as the hash of such pieces.
+def is_piece_stopped(torrent, piece_idx):
+  if not torrent.stopped_file_set:
+    return False
+  for file_idx, file_start, file_end in get_piece_files(torrent, piece_idx):
+    if file_end > file_start and file_idx not in torrent.pad_file_set and \
+       file_idx not in torrent.stopped_file_set:
+      return False
+
+  return True
+
+# Returns True if the reader feeds only zeros for a file: pad files and
+# missing or short files.
+def is_zero_file(torrent, file_idx):
+  if file_idx in torrent.pad_file_set:
+    return True
+  file_stat = torrent.file_stat_list[file_idx]
+
+  return not file_stat.exists or file_stat.size < torrent.file_length_list[file_idx]
+
+# SHA1 digests of runs of zeros are memoized by length. Pieces made only of
+# zeros have one of a few lengths (piece length, last piece length).
+__zero_digest_dict = {}
+
+def get_zero_digest(num_bytes):
+  digest = __zero_digest_dict.get(num_bytes)
+  if digest is None:
+    hasher = hashlib.sha1()
+    feed_zeros(hasher, num_bytes)
+    digest = hasher.digest()
+    if len(__zero_digest_dict) < 64:
+      __zero_digest_dict[num_bytes] = digest
+
+  return digest
+
+# Same as feed_piece() but with --maxReads no more than that number of pieces
+# are read at the same time by all threads and all torrents of a batch.
+__read_semaphore = None
+
+def feed_piece_bounded(torrent, piece_idx, hasher):
+  if __read_semaphore is None:
+    return feed_piece(torrent, piece_idx, hasher)
+  with __read_semaphore:
+    return feed_piece(torrent, piece_idx, hasher)
+
+# Pool of hashing threads shared by all torrents checked in a run
+__hash_executor = None
+__hash_executor_lock = threading.Lock()
+
+def get_hash_executor():
+  global __hash_executor
+  with __hash_executor_lock:
+    if __hash_executor is None:
+      __hash_executor = ThreadPoolExecutor(max_workers=__prog_options_jobs)
+
+  return __hash_executor
+
+# --- Prefetching pipeline ---
+# With --prefetch a reader thread reads pieces ahead into a bounded pool of
+# reused buffers while the main thread hashes them, so disk I/O and hashing
+# overlap. The number and size of the buffers are set with --prefetch and
+# --bufferSize.
+class PrefetchStopped(Exception):
+  pass
+
+# Hasher-like object used by the reader thread. feed_file() reads straight
+# into free buffers got with get_buffer(), data fed with update() (--mmap and
+# --directIO) is copied into them. Full buffers are queued for the hashing
+# stage. Runs of zeros are not copied, only their length is queued.
+# Queue items are (buffer, num_bytes, piece_end) where piece_end is None or
+# (piece_idx, file_idx_list) for the last buffer of a piece. buffer is None
+# for num_bytes zeros, and also for the end of a piece that ended exactly at
+# the end of a buffer. A (None, 0, None) item marks the end of the stream.
+class PrefetchFeeder:
+  def __init__(self, num_buffers, buffer_size):
+    self.free_queue = queue.Queue()
+    self.full_queue = queue.Queue()
+    for i in range(num_buffers):
+      self.free_queue.put(bytearray(buffer_size))
+    self.buffer = None
+    self.buffer_used = 0
+    self.stop_event = threading.Event()
+    self.error = None
+
+  def get_buffer(self, max_bytes):
+    """Returns the free part of the current buffer, at most max_bytes long."""
+    if self.buffer is None:
+      self.buffer = self.free_queue.get()
+      self.buffer_used = 0
+      if self.stop_event.is_set():
+        raise PrefetchStopped()
+
+    return memoryview(self.buffer)[self.buffer_used:self.buffer_used + max_bytes]
+
+  def buffer_filled(self, num_bytes):
+    """Called after num_bytes were written to the buffer from get_buffer()."""
+    self.buffer_used += num_bytes
+    if self.buffer_used == len(self.buffer):
+      self.queue_buffer()
+
+  def update(self, data):
+    data = memoryview(data)
+    while len(data) > 0:
+      buffer = self.get_buffer(len(data))
+      num_bytes = len(buffer)
+      buffer[:] = data[:num_bytes]
+      self.buffer_filled(num_bytes)
+      data = data[num_bytes:]
+
+  def add_zeros(self, num_bytes):
+    if num_bytes <= 0:
+      return
+    if self.buffer is not None and self.buffer_used > 0:
+      self.queue_buffer()
+    self.full_queue.put((None, num_bytes, None))
+
+  def queue_buffer(self):
+    self.full_queue.put((self.buffer, self.buffer_used, None))
+    self.buffer = None
+    self.buffer_used = 0
+
+  def end_piece(self, piece_idx, file_idx_list):
+    self.full_queue.put((self.buffer, self.buffer_used, (piece_idx, file_idx_list)))
+    self.buffer = None
+    self.buffer_used = 0
+
+  def end_stream(self):
+    self.full_queue.put((None, 0, None))
+
+  def stop(self):
+    """Called from the hashing stage to stop the reader thread."""
+    self.stop_event.set()
+    self.free_queue.put(bytearray(1))
+
+def prefetch_reader(torrent, pieces_range, feeder):
+  try:
+    for piece_idx in pieces_range:
+      if feeder.stop_event.is_set():
+        break
+      if is_piece_stopped(torrent, piece_idx):
+        feeder.end_piece(piece_idx, None)
+        continue
+      file_idx_list = feed_piece_bounded(torrent, piece_idx, feeder)
+      feeder.end_piece(piece_idx, file_idx_list)
+  except PrefetchStopped:
+    pass
+  except Exception as e:
+    feeder.error = e
+  feeder.end_stream()
+
+def prefetched_pieces_generator(torrent, pieces_range):
+  feeder = PrefetchFeeder(__prog_options_prefetch, __read_block_size)
+  reader = threading.Thread(target=prefetch_reader, args=(torrent, pieces_range, feeder))
+  reader.daemon = True
+  reader.start()
+  try:
+    hasher = new_piece_hasher()
+    while True:
+      buffer, num_bytes, piece_end = feeder.full_queue.get()
+      if buffer is None and num_bytes == 0 and piece_end is None:
+        break
+      if buffer is not None:
+        hasher.update(memoryview(buffer)[:num_bytes])
+        feeder.free_queue.put(buffer)
+      elif piece_end is None:
+        feed_zeros(hasher, num_bytes)
+      if piece_end is not None:
+        piece_idx, file_idx_list = piece_end
+        if file_idx_list is None:
+          # Stopped piece, nothing was read
+          file_idx_list = [piece_file[0] for piece_file in get_piece_files(torrent, piece_idx)]
+          yield (None, file_idx_list, piece_idx)
+          continue
+        yield (hasher.digest(), file_idx_list, piece_idx)
+        hasher = new_piece_hasher()
+    if feeder.error is not None:
+      raise feeder.error
+  finally:
+    feeder.stop()
+    reader.join()
+
+# --- Physical read order ---
+# With --readOrder inode or physical pieces are read sorted by the position
+# of their data on disk instead of piece order, which saves seeks on rotating
+# disks when a torrent has many small files. inode sorts by the inode of the
+# first file of each piece. physical uses the FIEMAP ioctl to get the disk
+# offset of the piece data and falls back to inode order for files whose
+# extents cannot be mapped. Results are put back in piece order before they
+# are reported.
+__FS_IOC_FIEMAP = 0xC020660B
+__fiemap_header = struct.Struct('=QQIIII')
+__fiemap_extent = struct.Struct('=QQQQQIIII')
+
+# Returns the list of (logical_offset, physical_offset) extents of a file, or
+# None if the filesystem does not support FIEMAP.
+def get_file_extents(path):
+  if fcntl is None:
+    return None
+  try:
+    fd = os.open(path, os.O_RDONLY)
+  except OSError:
+    return None
+  try:
+    # First call with no room for extents returns the number of extents
+    request = bytearray(__fiemap_header.pack(0, 0xFFFFFFFFFFFFFFFF, 0, 0, 0, 0))
+    fcntl.ioctl(fd, __FS_IOC_FIEMAP, request, True)
+    num_extents = __fiemap_header.unpack_from(request)[3]
+    if num_extents == 0:
+      return None
+    request = bytearray(__fiemap_header.size + num_extents * __fiemap_extent.size)
+    __fiemap_header.pack_into(request, 0, 0, 0xFFFFFFFFFFFFFFFF, 0, 0, num_extents, 0)
+    fcntl.ioctl(fd, __FS_IOC_FIEMAP, request, True)
+    num_extents = __fiemap_header.unpack_from(request)[3]
+  except OSError:
+    return None
+  finally:
+    os.close(fd)
+  extent_list = []
+  for i in range(num_extents):
+    extent = __fiemap_extent.unpack_from(request, __fiemap_header.size + i * __fiemap_extent.size)
+    extent_list.append((extent[0], extent[1]))
+
+  return extent_list
+
+# Returns the pieces sorted in the order they must be read. Pieces with no
+# data on disk go first since they are not read.
+def get_pieces_read_order(torrent, pieces_range):
+  file_extents_dict = {}
+  key_list = []
+  for piece_idx in pieces_range:
+    key = (-1, 0, 0, piece_idx)
+    for file_idx, file_start, file_end in get_piece_files(torrent, piece_idx):
+      file_stat = torrent.file_stat_list[file_idx]
+      if not file_stat.exists:
+        continue
+      extent_list = None
+      if __prog_options_readOrder == 'physical':
+        if file_idx not in file_extents_dict:
+          file_extents_dict[file_idx] = get_file_extents(torrent_file_path(torrent, file_idx))
+        extent_list = file_extents_dict[file_idx]
+      if extent_list:
+        extent_idx = max(0, bisect_left(extent_list, (file_start + 1, 0)) - 1)
+        extent_logical, extent_physical = extent_list[extent_idx]
+        key = (file_stat.dev, 0, extent_physical + file_start - extent_logical, piece_idx)
+      else:
+        key = (file_stat.dev, 1, file_stat.inode, file_start)
+      break
+    key_list.append((key, piece_idx))
+  key_list.sort()
+
+  return [piece_idx for key, piece_idx in key_list]
+
+# --- Per device scheduler ---
+# With --deviceJobs pieces are grouped by the device (st_dev) their data is
+# stored on and every device gets its own reader threads, which take the
+# pieces of that device in order. Disks are read in parallel instead of one
+# after another. Readers hash the pieces they read; hashlib releases the GIL
+# so hashing of all devices runs concurrently too. Readers do not take a
+# piece more than window pieces ahead of the one the consumer waits for, so
+# results consumed late (--perFileStop) are not read too early.
+class DeviceScheduler:
+  def __init__(self, torrent, pieces_range, readers_per_device):
+    self.torrent = torrent
+    self.condition = threading.Condition()
+    self.results = {} # piece_idx -> (piece_hash, file_idx_list)
+    self.stopped = False
+    self.error = None
+    self.device_queues = OrderedDict() # st_dev -> deque of (position, piece_idx)
+    for position, piece_idx in enumerate(pieces_range):
+      device = get_piece_device(torrent, piece_idx)
+      self.device_queues.setdefault(device, deque()).append((position, piece_idx))
+    # Position in pieces_range of the next result the consumer takes
+    self.next_position = 0
+    self.window = 2 * readers_per_device * len(self.device_queues)
+    self.threads = []
+    for device, piece_queue in self.device_queues.items():
+      for i in range(readers_per_device):
+        thread = threading.Thread(target=self.reader, args=(piece_queue,))
+        thread.daemon = True
+        self.threads.append(thread)
+
+  def start(self):
+    for thread in self.threads:
+      thread.start()
+
+  def reader(self, piece_queue):
+    try:
+      while True:
+        with self.condition:
+          while piece_queue and not self.stopped and self.error is None and \
+                piece_queue[0][0] >= self.next_position + self.window:
+            self.condition.wait()
+          if self.stopped or self.error is not None or not piece_queue:
+            return
+          position, piece_idx = piece_queue.popleft()
+        result = hash_piece(self.torrent, piece_idx)
+        with self.condition:
+          self.results[piece_idx] = result
+          self.condition.notify_all()
+    except Exception as e:
+      with self.condition:
+        self.error = e
+        self.condition.notify_all()
+
+  def get_result(self, piece_idx):
+    """Waits until piece_idx has been hashed and returns its result."""
+    with self.condition:
+      while piece_idx not in self.results:
+        if self.error is not None:
+          raise self.error
+        self.condition.wait()
+      self.next_position += 1
+      self.condition.notify_all()
+      return self.results.pop(piece_idx)
+
+  def stop(self):
+    with self.condition:
+      self.stopped = True
+      self.condition.notify_all()
+    for thread in self.threads:
+      thread.join()
+
+# Returns the st_dev of the first existing file of a piece, or None if the
+# piece has no data on disk.
+def get_piece_device(torrent, piece_idx):
+  for file_idx, file_start, file_end in get_piece_files(torrent, piece_idx):
+    file_stat = torrent.file_stat_list[file_idx]
+    if file_stat.exists:
+      return file_stat.dev
+
+  return None
+
+def device_pieces_generator(torrent, pieces_range):
+  scheduler = DeviceScheduler(torrent, pieces_range, __prog_options_deviceJobs)
+  scheduler.start()
+  try:
+    for piece_idx in pieces_range:
+      piece_hash, file_idx_list = scheduler.get_result(piece_idx)
+      yield (piece_hash, file_idx_list, piece_idx)
+  finally:
+    scheduler.stop()
+
+# Yields (piece_hash, file_idx_list, piece_idx) tuples. If more than one job
+# is requested pieces are read and hashed concurrently by a pool of threads,
+# but results are always returned in piece order. The number of pieces in
+# flight is bounded so memory usage is a few read blocks per worker. With
+# --prefetch pieces are read by a reader thread ahead of hashing. With
+# --deviceJobs every device is read by its own threads. With --readOrder
+# pieces are read in disk order and reordered before they are returned.
+def hashed_pieces_generator(torrent, pieces_list=None):
   pieces_range = range(torrent.num_pieces)
   if pieces_list != None:
     pieces_range = pieces_list
+  try:
+    if __prog_options_readOrder == 'logical':
+      yield from read_pieces_generator(torrent, pieces_range)
+      return
+
+    # Reassemble results in piece order. Results are small so pieces that
+    # arrive early are simply kept in a dictionary.
+    read_list = get_pieces_read_order(torrent, pieces_range)
+    result_dict = {}
+    result_iterator = iter(pieces_range)
+    next_idx = next(result_iterator, None)
+    for piece_hash, file_idx_list, piece_idx in read_pieces_generator(torrent, read_list):
+      result_dict[piece_idx] = (piece_hash, file_idx_list)
+      while next_idx is not None and next_idx in result_dict:
+        piece_hash, file_idx_list = result_dict.pop(next_idx)
+        yield (piece_hash, file_idx_list, next_idx)
+        next_idx = next(result_iterator, None)
+  finally:
+    __file_handle_cache.close_all()
+    __mmap_cache.close_all()
+
+# Yields (piece_hash, file_idx_list, piece_idx) tuples in the order of
+# pieces_range.
+def read_pieces_generator(torrent, pieces_range):
+  num_jobs = __prog_options_jobs
+  pending = deque()
+  try:
+    if __prog_options_prefetch > 0:
+      yield from prefetched_pieces_generator(torrent, pieces_range)
+      return
+
+    if __prog_options_deviceJobs > 0:
+      yield from device_pieces_generator(torrent, pieces_range)
+      return
+
+    if num_jobs <= 1:
+      for piece_idx in pieces_range:
+        piece_hash, file_idx_list = hash_piece(torrent, piece_idx)
+        yield (piece_hash, file_idx_list, piece_idx)
+      return
+
+    max_pending = 2 * num_jobs
+    executor = get_hash_executor()
+    for piece_idx in pieces_range:
+      pending.append((executor.submit(hash_piece, torrent, piece_idx), piece_idx))
+      if len(pending) >= max_pending:
+        future, done_idx = pending.popleft()
+        piece_hash, file_idx_list = future.result()
+        yield (piece_hash, file_idx_list, done_idx)
+    while pending:
+      future, done_idx = pending.popleft()
+      piece_hash, file_idx_list = future.result()
+      yield (piece_hash, file_idx_list, done_idx)
+  finally:
+    # Generator closed early, do not hash the remaining pieces
+    for future, done_idx in pending:
+      future.cancel()
+    for future, done_idx in pending:
+      if not future.cancelled():
+        future.exception()
+
+# --- Verification cache ---
+# Piece results are stored on disk, one JSON file per torrent named after the
+# torrent info-hash. Each file records the key (size, mtime_ns, inode) of
+# every torrent file at the time it was hashed, and one character per piece:
+# G good, B bad, ? not checked. On the next run pieces whose files have the
+# same key are taken from the cache and only dirty pieces are hashed again.
+__verify_cache_version = 1
+__piece_status_good    = ord('G')
+__piece_status_bad     = ord('B')
+__piece_status_unknown = ord('?')
+# Only used while checking, never stored in the cache
+__piece_status_nodata  = ord('N')
+
+def get_verify_cache_dir():
+  cache_home = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+
+  return os.path.join(cache_home, 'torrentverify')
+
+def get_verify_cache_path(torrent):
+  return os.path.join(get_verify_cache_dir(), torrent.info_hash + '.json')
+
+def get_file_cache_key(file_stat):
+  return [file_stat.size, file_stat.mtime_ns, file_stat.inode]
+
+# Returns a bytearray with the status of every piece. Pieces not in the
+# cache or whose files changed since they were hashed are unknown.
+def load_verify_cache(torrent):
+  piece_status = bytearray([__piece_status_unknown]) * torrent.num_pieces
+  try:
+    with open(get_verify_cache_path(torrent), 'r') as cache_file:
+      cache = json.load(cache_file)
+  except (OSError, ValueError):
+    return piece_status
+  if cache.get('version') != __verify_cache_version or \
+     cache.get('dir_data') != os.path.abspath(torrent.dir_data) or \
+     len(cache.get('files', [])) != torrent.num_files or \
+     len(cache.get('pieces', '')) != torrent.num_pieces:
+    return piece_status
+
+  piece_status[:] = cache['pieces'].encode('ascii')
+  for i in range(torrent.num_files):
+    if cache['files'][i] != get_file_cache_key(torrent.file_stat_list[i]):
+      for piece_idx in get_file_pieces(torrent, i):
+        piece_status[piece_idx] = __piece_status_unknown
+
+  return piece_status
+
+# Writes the piece status of a torrent to the cache and evicts the least
+# recently written torrents if the cache grows over its size.
+def save_verify_cache(torrent, piece_status):
+  cache_dir = get_verify_cache_dir()
+  cache_path = get_verify_cache_path(torrent)
+  cache = {
+    'version'  : __verify_cache_version,
+    'dir_data' : os.path.abspath(torrent.dir_data),
+    'files'    : [get_file_cache_key(file_stat) for file_stat in torrent.file_stat_list],
+    'pieces'   : piece_status.decode('ascii')
+  }
+  try:
+    os.makedirs(cache_dir, exist_ok=True)
+    __verify_cache_index.load(cache_dir)
+    # Unique name, torrents of a batch may share the same info hash
+    temp_path = '{0}.{1}.{2}.tmp'.format(cache_path, os.getpid(), threading.get_ident())
+    cache_data = json.dumps(cache)
+    with open(temp_path, 'w') as cache_file:
+      cache_file.write(cache_data)
+    os.replace(temp_path, cache_path)
+
+    for path in __verify_cache_index.add(cache_path, len(cache_data)):
+      try:
+        os.unlink(path)
+      except FileNotFoundError:
+        pass
+  except OSError as e:
+    print('[WARNING] Cannot write verification cache: {0}'.format(e))
+
+# Modification time and size of the cache files, read with a single scan of
+# the cache directory the first time the cache is written. When a new entry
+# takes the cache over max_bytes the least recently written entries are
+# evicted. Rewriting an entry never evicts. Entries written by other
+# processes are seen on the next run.
+class VerifyCacheIndex:
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.lock = threading.Lock()
+    self.entries = None # path -> (mtime, size)
+    self.total_bytes = 0
+
+  def load(self, cache_dir):
+    with self.lock:
+      if self.entries is not None:
+        return
+      self.entries = {}
+      for entry in os.scandir(cache_dir):
+        if not entry.name.endswith('.json'):
+          continue
+        try:
+          entry_stat = entry.stat()
+        except FileNotFoundError:
+          continue
+        self.entries[entry.path] = (entry_stat.st_mtime, entry_stat.st_size)
+        self.total_bytes += entry_stat.st_size
+
+  def add(self, path, size):
+    """Records a written entry. Returns the list of entries to evict."""
+    evict_list = []
+    with self.lock:
+      old_entry = self.entries.get(path)
+      if old_entry is not None:
+        self.total_bytes -= old_entry[1]
+      self.entries[path] = (time.time(), size)
+      self.total_bytes += size
+      if old_entry is None and self.total_bytes > self.max_bytes:
+        for mtime, old_path in sorted((entry[0], entry_path) for entry_path, entry in self.entries.items()):
+          if self.total_bytes <= self.max_bytes:
+            break
+          if old_path == path:
+            continue
+          self.total_bytes -= self.entries.pop(old_path)[1]
+          evict_list.append(old_path)
+
+    return evict_list
+
+__verify_cache_index = VerifyCacheIndex(1024 * 1024 * 1024)
+
+# Returns True if all the data of a piece is in missing or short files. The
+# reader would hash such a piece as zeros, so it is reported as bad without
+# reading or hashing anything: its data is not on disk.
+# Pieces made only of pad files are not considered.
+def is_piece_without_data(torrent, piece_idx):
+  has_missing_data = False
+  for file_idx, file_start, file_end in get_piece_files(torrent, piece_idx):
+    if file_end == file_start or file_idx in torrent.pad_file_set:
+      continue
+    if not is_zero_file(torrent, file_idx):
+      return False
+    has_missing_data = True
+
+  return has_missing_data
+
+# Yields (hash_status, file_idx_list, piece_idx) tuples in piece order.
+# hash_status is GOOD_SHA, BAD_SHA or SKIPPED for pieces not read because of
+# --perFileStop. Unless --noCache is used results are
+# taken from the verification cache when possible and only dirty pieces are
+# hashed. --rehash (or rehash True) hashes all pieces again but still
+# updates the cache.
+# The number of pieces taken from the cache is left in
+# torrent.num_cached_pieces.
+def checked_pieces_generator(torrent, pieces_list=None, rehash=False):
+  pieces_range = range(torrent.num_pieces)
+  if pieces_list != None:
+    pieces_range = pieces_list
+  use_cache = not __prog_options_noCache
+  if use_cache:
+    piece_status = load_verify_cache(torrent)
+  else:
+    piece_status = bytearray([__piece_status_unknown]) * torrent.num_pieces
+  if __prog_options_rehash or rehash:
+    for piece_idx in pieces_range:
+      piece_status[piece_idx] = __piece_status_unknown
+  # Pieces with no data on disk are bad, there is no need to read them
+  torrent.num_nodata_pieces = 0
   for piece_idx in pieces_range:
-    # Get list of files for this piece
-    this_piece_files_list = torrent.pieces_file_list[piece_idx]
-    # Iterate through files and make piece
-    piece = b''
-    file_idx_list = []
-    for file_idx in range(len(this_piece_files_list)):
-      # Get file info
-      file_dict = this_piece_files_list[file_idx]
-      file_name = torrent.file_name_list[file_dict['file_idx']]
-      file_start = file_dict['start_offset']
-      file_end = file_dict['end_offset']
-      file_correct_size = torrent.file_length_list[file_dict['file_idx']]
-      file_idx_list.append(file_dict['file_idx'])
-      # Read file
-      path = os.path.join(torrent.dir_data, file_name)
-      file_exists = os.path.isfile(path)
-      if file_exists:
-        file_size = os.path.getsize(path)
-        if file_size == file_correct_size:
-          # If downloaded file has correct size then read whithin the file
-          # limits. Maybe the whole file if file is smaller than the piece size
-          sfile = open(path, "rb")
-          sfile.seek(file_start)
-          piece += sfile.read(file_end - file_start)
-          sfile.close()
-        elif file_size < file_correct_size:
-          # If downloaded file has less size then pad with zeros.
-          # To simplify things, treat file as if it doesn't exist.
-          # Consequently, SHA1 check will fail.
-          piece += bytearray(file_end - file_start)
+    if piece_status[piece_idx] == __piece_status_unknown and is_piece_without_data(torrent, piece_idx):
+      piece_status[piece_idx] = __piece_status_nodata
+  dirty_pieces_list = [piece_idx for piece_idx in pieces_range
+                       if piece_status[piece_idx] == __piece_status_unknown]
+
+  torrent.num_cached_pieces = 0
+  hashed_pieces = hashed_pieces_generator(torrent, dirty_pieces_list)
+  try:
+    for piece_idx in pieces_range:
+      if piece_status[piece_idx] == __piece_status_unknown:
+        piece_hash, file_idx_list, hashed_idx = next(hashed_pieces)
+        if piece_hash is None:
+          yield ('SKIPPED', file_idx_list, piece_idx)
+          continue
+        if piece_hash == torrent.pieces_hash_list[piece_idx]:
+          piece_status[piece_idx] = __piece_status_good
         else:
-          # If downloaded file has more size then truncate file read. Note that 
-          # SHA1 check may succed, but file will have an incorrect bigger size 
-          # that must be truncated later.
-          sfile = open(path, "rb")
-          sfile.seek(file_start)
-          piece += sfile.read(file_end - file_start)
-          sfile.close()         
+          piece_status[piece_idx] = __piece_status_bad
+      elif piece_status[piece_idx] == __piece_status_nodata:
+        file_idx_list = [piece_file[0] for piece_file in get_piece_files(torrent, piece_idx)]
+        piece_status[piece_idx] = __piece_status_bad
+        torrent.num_nodata_pieces += 1
+      else:
+        file_idx_list = [piece_file[0] for piece_file in get_piece_files(torrent, piece_idx)]
+        torrent.num_cached_pieces += 1
+      if piece_status[piece_idx] == __piece_status_good:
+        yield ('GOOD_SHA', file_idx_list, piece_idx)
       else:
-        # If file does not exists at all, just pad with zeros
-        piece += bytearray(file_end - file_start)
-    # Yield piece
-    yield (piece, file_idx_list, piece_idx)
+        yield ('BAD_SHA', file_idx_list, piece_idx)
+  finally:
+    hashed_pieces.close()
+    if use_cache:
+      save_verify_cache(torrent, piece_status.replace(bytes([__piece_status_nodata]),
+                                                      bytes([__piece_status_unknown])))
+
+# --- Hash check report ---
+# --format table prints one line per piece and file, jsonl one JSON object
+# per piece, file and a final summary, and summary only the per-file rollup
+# and the summary. By default only pieces that are not OK are reported, all
+# of them with --allPieces. Output is written in blocks since a big torrent
+# may have millions of lines.
+class BlockWriter:
+  def __init__(self, stream, block_size = 64 * 1024):
+    self.stream = stream
+    self.block_size = block_size
+    self.line_list = []
+    self.num_chars = 0
+
+  def write_line(self, line):
+    self.line_list.append(line)
+    self.num_chars += len(line) + 1
+    if self.num_chars >= self.block_size:
+      self.flush()
+
+  def flush(self):
+    if self.line_list:
+      self.line_list.append('')
+      self.stream.write('\n'.join(self.line_list))
+      self.line_list = []
+      self.num_chars = 0
+    self.stream.flush()
+
+__report_output = BlockWriter(sys.stdout)
+
+# Per-file result of a hash check. hash_status of a file is VERIFIED if all
+# its pieces were checked and are good, BAD_SHA if some piece is bad and
+# PARTIAL if only some of its pieces were checked (--checkFile).
+class FileRollup:
+  def __init__(self, torrent):
+    self.good_pieces = array('L', [0]) * torrent.num_files
+    self.bad_pieces = array('L', [0]) * torrent.num_files
+
+  def add_piece(self, hash_status, file_idx_list):
+    counter_list = self.good_pieces if hash_status == 'GOOD_SHA' else self.bad_pieces
+    for file_idx in file_idx_list:
+      counter_list[file_idx] += 1
+
+  def get_hash_status(self, torrent, file_idx):
+    if self.bad_pieces[file_idx]:
+      return 'BAD_SHA'
+    if self.good_pieces[file_idx] < len(get_file_pieces(torrent, file_idx)):
+      return 'PARTIAL'
+    return 'VERIFIED'
+
+def print_piece_lines(torrent, hash_status, file_idx_list, piece_index):
+  text_size = 7+7+9+9+17+17+1
+  for file_idx in file_idx_list:
+    file_status, file_size = get_file_status(torrent, file_idx)
+    line = '{0:06d} {1:6} {2:>8} {3:>8} {4:16,} {5:16,}  {6}'.format(
+      piece_index+1, file_idx+1, hash_status, file_status, file_size,
+      torrent.file_length_list[file_idx],
+      limit_string_lentgh(torrent.file_name_list[file_idx], __cols -text_size))
+    # --- Print odd/even pieces with different colors
+    if piece_index % 2:
+      __report_output.write_line(line)
+    else:
+      __report_output.write_line('\033[0;97m' + line + '\033[0m')
 
-# Checks torrent files against SHA1 hash for integrity
-def check_torrent_files_hash(torrent):
+def print_piece_json(torrent, hash_status, file_idx_list, piece_index):
+  file_list = []
+  for file_idx in file_idx_list:
+    file_status, file_size = get_file_status(torrent, file_idx)
+    file_list.append({'file' : file_idx+1, 'status' : file_status, 'size' : file_size,
+                      'length' : torrent.file_length_list[file_idx],
+                      'name' : torrent.file_name_list[file_idx]})
+  __report_output.write_line(json.dumps({'type' : 'piece', 'piece' : piece_index+1,
+                                         'status' : hash_status, 'files' : file_list}))
+
+def print_file_rollup(torrent, rollup, file_idx_list):
+  text_size = 7+9+9+13+13+1
+  header_printed = False
+  for file_idx in file_idx_list:
+    file_status, file_size = get_file_status(torrent, file_idx)
+    hash_status = rollup.get_hash_status(torrent, file_idx)
+    if file_status == 'PAD' and not __prog_options_allPieces:
+      continue
+    if file_status == 'OK' and hash_status == 'VERIFIED' and not __prog_options_allPieces:
+      continue
+    if __prog_options_format == 'jsonl':
+      __report_output.write_line(json.dumps({'type' : 'file', 'file' : file_idx+1,
+        'status' : file_status, 'hash_status' : hash_status, 'size' : file_size,
+        'length' : torrent.file_length_list[file_idx],
+        'good_pieces' : rollup.good_pieces[file_idx],
+        'bad_pieces' : rollup.bad_pieces[file_idx],
+        'name' : torrent.file_name_list[file_idx]}))
+      continue
+    if not header_printed:
+      __report_output.write_line('')
+      __report_output.write_line(' file#  FStatus  HStatus  Good pieces   Bad pieces  File name')
+      __report_output.write_line('------ -------- -------- ------------ ------------  --------------')
+      header_printed = True
+    __report_output.write_line('{0:6} {1:>8} {2:>8} {3:12,} {4:12,}  {5}'.format(
+      file_idx+1, file_status, hash_status, rollup.good_pieces[file_idx],
+      rollup.bad_pieces[file_idx],
+      limit_string_lentgh(torrent.file_name_list[file_idx], __cols -text_size)))
+
+# Checks the pieces in pieces_list (all if None) and reports the pieces, the
+# files in file_idx_list and a summary.
+def report_torrent_hash_check(torrent, pieces_list, file_idx_list, sample=None):
   ret_value = 0
-  print('piece#  file#  HStatus  FStatus     Actual Bytes    Torrent Bytes  File name')
-  print('------ ------ -------- -------- ---------------- ----------------  --------------')
-  num_files_OK_list = []
-  num_files_bigger_size_list = []
-  num_files_smaller_size_list = []
-  num_files_missing_list = []
+  take_file_stat_snapshot(torrent)
+  report_format = __prog_options_format
+  if report_format == 'table':
+    __report_output.write_line('piece#  file#  HStatus  FStatus     Actual Bytes    Torrent Bytes  File name')
+    __report_output.write_line('------ ------ -------- -------- ---------------- ----------------  --------------')
+  rollup = FileRollup(torrent)
+  file_ok_list = [get_file_status(torrent, file_idx)[0] in ('OK', 'PAD') for file_idx in range(torrent.num_files)]
+  progress = None
+  if __prog_options_progress:
+    if pieces_list is None:
+      progress = ProgressLine(torrent.total_bytes)
+    else:
+      progress = ProgressLine(len(pieces_list) * torrent.piece_length)
   piece_counter = 0
+  bytes_checked = 0
   good_pieces = 0
   bad_pieces = 0
-  for piece, file_idx_list, piece_index in pieces_generator(torrent):
-    # --- Compare piece hash with expected hash
-    piece_hash = hashlib.sha1(piece).digest()
-    if piece_hash != torrent.pieces_hash_list[piece_index]:
-      hash_status = 'BAD_SHA'
+  bad_random_pieces = 0
+  skipped_pieces = 0
+  fail_fast_stop = False
+  torrent.have_pieces = bytearray(torrent.num_pieces)
+  # Sampled pieces are always hashed, the cache cannot see bit rot
+  checked_pieces = checked_pieces_generator(torrent, pieces_list, rehash=sample is not None)
+  for hash_status, piece_file_idx_list, piece_index in checked_pieces:
+    if progress is not None:
+      progress.update(get_piece_size(torrent, piece_index))
+    if hash_status == 'SKIPPED':
+      skipped_pieces += 1
+      continue
+    bytes_checked += get_piece_size(torrent, piece_index)
+    if hash_status == 'BAD_SHA':
       bad_pieces += 1
       ret_value = 1
+      if sample is not None and piece_index in sample.random_set:
+        bad_random_pieces += 1
+      if __prog_options_perFileStop:
+        torrent.stopped_file_set.update(piece_file_idx_list)
+      # Closing the generator ends the loop after this piece is reported
+      if __prog_options_failFast:
+        fail_fast_stop = True
+        checked_pieces.close()
     else:
-      hash_status = 'GOOD_SHA'
       good_pieces += 1
+      torrent.have_pieces[piece_index] = 1
+    rollup.add_piece(hash_status, piece_file_idx_list)
+    piece_counter += 1
 
     # --- Print information
-    for i in range(len(file_idx_list)):
-      file_idx = file_idx_list[i]
-      path = os.path.join(torrent.dir_data, torrent.file_name_list[file_idx])
-      file_exists = os.path.isfile(path)
-      if file_exists:
-        file_size = os.path.getsize(path)
-        if file_size == torrent.file_length_list[file_idx]:
-          file_status = 'OK'
-          num_files_OK_list.append(file_idx)
-        else:
-          file_status = 'BAD_SIZE'
-          ret_value = 1
-          if file_size > torrent.file_length_list[file_idx]:
-            num_files_bigger_size_list.append(file_idx)
-          else:
-            num_files_smaller_size_list.append(file_idx)
-      else:
-        file_size = -1
-        file_status = 'MISSING'
-        ret_value = 1
-        num_files_missing_list.append(file_idx)
-      # --- Print odd/even pieces with different colors
-      text_size = 7+7+9+9+17+17+1
-      if piece_index % 2:
-        print('{0:06d} {1:6} {2:>8} {3:>8} {4:16,} {5:16,}  {6}'
-          .format(piece_index+1, file_idx+1, hash_status, file_status, 
-                  file_size, torrent.file_length_list[file_idx], 
-                  limit_string_lentgh(torrent.file_name_list[file_idx], __cols -text_size)))
+    if report_format == 'summary':
+      continue
+    if not __prog_options_allPieces and hash_status == 'GOOD_SHA' and \
+       all(file_ok_list[file_idx] for file_idx in piece_file_idx_list):
+      continue
+    start_time = time.perf_counter()
+    if report_format == 'table':
+      print_piece_lines(torrent, hash_status, piece_file_idx_list, piece_index)
+    else:
+      print_piece_json(torrent, hash_status, piece_file_idx_list, piece_index)
+    add_run_time('output', start_time)
+  if progress is not None:
+    progress.finish()
+  if __run_stats is not None:
+    __run_stats.add_pieces(piece_counter, bytes_checked)
+  start_time = time.perf_counter()
+  print_file_rollup(torrent, rollup, file_idx_list)
+
+  # --- Count files
+  num_files_OK = num_files_bigger_size = num_files_smaller_size = num_files_missing = 0
+  num_files_verified = num_files_bad_pieces = 0
+  for file_idx in file_idx_list:
+    file_status, file_size = get_file_status(torrent, file_idx)
+    hash_status = rollup.get_hash_status(torrent, file_idx)
+    if file_status == 'PAD':
+      continue
+    if file_status == 'OK':
+      num_files_OK += 1
+      if hash_status == 'VERIFIED':
+        num_files_verified += 1
+    elif file_status == 'BAD_SIZE':
+      ret_value = 1
+      if file_size > torrent.file_length_list[file_idx]:
+        num_files_bigger_size += 1
       else:
-        print('\033[0;97m{0:06d} {1:6} {2:>8} {3:>8} {4:16,} {5:16,}  {6}\033[0m'
-          .format(piece_index+1, file_idx+1, hash_status, file_status, 
-                  file_size, torrent.file_length_list[file_idx], 
-                  limit_string_lentgh(torrent.file_name_list[file_idx], __cols -text_size)))
-    # --- Increment piece counter
-    piece_counter += 1
-
-  # --- Make lists set to avoid duplicates
-  num_files_OK_set           = set(num_files_OK_list)
-  num_files_bigger_size_set  = set(num_files_bigger_size_list)
-  num_files_smaller_size_set = set(num_files_smaller_size_list)
-  num_files_missing_set      = set(num_files_missing_list)
+        num_files_smaller_size += 1
+    else:
+      ret_value = 1
+      num_files_missing += 1
+    if hash_status == 'BAD_SHA':
+      num_files_bad_pieces += 1
+
+  # --- Print summary
+  if report_format == 'jsonl':
+    __report_output.write_line(json.dumps({'type' : 'summary',
+      'torrent' : torrent.torrent_file, 'info_hash' : torrent.info_hash,
+      'pieces' : torrent.num_pieces, 'piece_length' : torrent.piece_length,
+      'files' : torrent.num_files, 'total_bytes' : torrent.total_bytes,
+      'data_directory' : torrent.dir_data,
+      'files_ok' : num_files_OK, 'files_bigger' : num_files_bigger_size,
+      'files_smaller' : num_files_smaller_size, 'files_missing' : num_files_missing,
+      'files_verified' : num_files_verified, 'files_bad_pieces' : num_files_bad_pieces,
+      'pieces_checked' : piece_counter, 'pieces_from_cache' : torrent.num_cached_pieces,
+      'pieces_without_data' : torrent.num_nodata_pieces,
+      'good_pieces' : good_pieces, 'bad_pieces' : bad_pieces}))
+    if __prog_options_failFast or __prog_options_perFileStop:
+      __report_output.write_line(json.dumps({'type' : 'stop', 'fail_fast_stop' : fail_fast_stop,
+        'skipped_pieces' : skipped_pieces}))
+    if sample is not None:
+      __report_output.write_line(json.dumps({'type' : 'sample', 'seed' : sample.seed,
+        'pieces' : len(sample.pieces_list), 'random_pieces' : len(sample.random_set),
+        'population' : sample.population, 'bad_random_pieces' : bad_random_pieces,
+        'bad_fraction' : get_sample_bad_fraction(sample, bad_random_pieces)}))
+    __report_output.flush()
+    add_run_time('output', start_time)
+    return ret_value
+  __report_output.flush()
+  add_run_time('output', start_time)
 
   # --- Print torrent metadata
   print('')
@@ -765,15 +2607,25 @@ def check_torrent_files_hash(torrent):
   print('Torrent directory   : {0}'.format(torrent.dir_name))
   print('Download directory  : {0}'.format(torrent.dir_download))
   print('Data directory      : {0}'.format(torrent.dir_data))
-  print('Files OK            : {0:12,}'.format(len(num_files_OK_set)))
-  print('Files w big size    : {0:12,}'.format(len(num_files_bigger_size_set)))
-  print('Files w small size  : {0:12,}'.format(len(num_files_smaller_size_set)))
-  print('Files missing       : {0:12,}'.format(len(num_files_missing_set)))
+  print('Files OK            : {0:12,}'.format(num_files_OK))
+  print('Files w big size    : {0:12,}'.format(num_files_bigger_size))
+  print('Files w small size  : {0:12,}'.format(num_files_smaller_size))
+  print('Files missing       : {0:12,}'.format(num_files_missing))
+  print('Files verified      : {0:12,}'.format(num_files_verified))
+  print('Files w bad pieces  : {0:12,}'.format(num_files_bad_pieces))
   print('# of pieces checked : {0:12,}'.format(piece_counter))
+  print('Pieces from cache   : {0:12,}'.format(torrent.num_cached_pieces))
+  print('Pieces w/o data     : {0:12,}'.format(torrent.num_nodata_pieces))
   print('Good pieces         : {0:12,}'.format(good_pieces))
   print('Bad pieces          : {0:12,}'.format(bad_pieces))
-
-  if bad_pieces == 0 and len(num_files_bigger_size_set):
+  if __prog_options_perFileStop:
+    print('Pieces skipped      : {0:12,}'.format(skipped_pieces))
+  if fail_fast_stop:
+    print('Stopped at the first bad piece (--failFast)')
+  if sample is not None:
+    print_sample_summary(torrent, sample, bad_random_pieces)
+
+  if bad_pieces == 0 and num_files_bigger_size:
     print("""WARNING
  Downloaded files pass SHA check but some files are bigger than they should be.
  Run torrentverify with --check and --truncateWrongSizeFiles parameters to correct the 
@@ -782,111 +2634,684 @@ def check_torrent_files_hash(torrent):
 
   return ret_value
 
-# Checks single file against SHA1 hash for integrity
-__debug_file_location_in_torrent = 0
-def check_torrent_files_single_hash(torrent, fileName):
-  ret_value = 0
-
-  # Remove torrent download directory from path
-  dir_data = torrent.dir_data
-  fileName_search = fileName.replace(dir_data, '');
-  fileName_search = fileName_search.strip('/')
-  
-  if __debug_file_location_in_torrent:
-    print('dir_data         {0}'.format(dir_data))
-    print('fileName         {0}'.format(fileName))
-    print('fileName_search  {0}'.format(fileName_search))
-
-  # Locate which pieces of the torrent this file spans
-  pieces_list = []
-  for piece_idx in range(torrent.num_pieces):
-    if __debug_file_location_in_torrent:
-      print('Piece {0:6}'.format(piece_idx))
-    this_piece_files_list = torrent.pieces_file_list[piece_idx]
-    for file_idx in range(len(this_piece_files_list)):
-      # Get file info
-      cfile_dict = this_piece_files_list[file_idx]
-      file_name = torrent.file_name_list[cfile_dict['file_idx']]
-      if file_name == fileName_search:
-        if __debug_file_location_in_torrent:
-          print('  MATCHED  {0}'.format(file_name))
-        pieces_list.append(piece_idx)
+# Checks torrent files against SHA1 hash for integrity
+def check_torrent_files_hash(torrent):
+  if use_v2_hash(torrent):
+    return report_torrent_v2_check(torrent, range(torrent.num_files))
+  return report_torrent_hash_check(torrent, None, range(torrent.num_files))
+
+# --- Sampling check ---
+# --checkSample hashes a reproducible random sample of pieces plus the first
+# and last piece of every file, where truncation and zero filling show up
+# first. Random pieces are drawn uniformly from the rest, so the number of
+# bad ones found bounds the fraction of bad pieces in the torrent.
+# population is the number of pieces random pieces are drawn from.
+PieceSample = namedtuple('PieceSample', ['pieces_list', 'random_set', 'population', 'seed'])
+__sample_confidence = 0.95
+
+# Returns the number of pieces of a --checkSample argument: N pieces or P%
+# of the pieces of the torrent. Returns None if the argument is not valid.
+def get_sample_size(torrent, sample_option):
+  try:
+    if sample_option.endswith('%'):
+      percent = float(sample_option[:-1])
+      if not 0 < percent <= 100:
+        return None
+      return max(1, int(round(torrent.num_pieces * percent / 100)))
+    num_pieces = int(sample_option)
+  except ValueError:
+    return None
+
+  return num_pieces if num_pieces > 0 else None
+
+# Returns a PieceSample of sample_size random pieces plus the first and last
+# piece of every file. The seed defaults to the info hash so the same torrent
+# is sampled the same way every time.
+def get_pieces_sample(torrent, sample_size, seed=None):
+  if seed is None:
+    seed = torrent.info_hash
+  edge_set = set()
+  for file_idx in range(torrent.num_files):
+    if file_idx in torrent.pad_file_set or torrent.file_length_list[file_idx] == 0:
+      continue
+    file_pieces = get_file_pieces(torrent, file_idx)
+    edge_set.add(file_pieces[0])
+    edge_set.add(file_pieces[-1])
+  population = [piece_idx for piece_idx in range(torrent.num_pieces) if piece_idx not in edge_set]
+  num_random = min(len(population), sample_size)
+  random_list = random.Random(seed).sample(population, num_random)
+
+  return PieceSample(sorted(edge_set.union(random_list)), set(random_list), len(population), seed)
+
+# Estimated fraction of bad pieces. If no random piece is bad it is the upper
+# bound of the fraction at __sample_confidence: the probability of drawing n
+# good pieces when a fraction f is bad is at most (1 - f)^n.
+def get_sample_bad_fraction(sample, bad_random_pieces):
+  num_random = len(sample.random_set)
+  if num_random == sample.population:
+    return bad_random_pieces / num_random if num_random else 0.0
+  if bad_random_pieces > 0:
+    return bad_random_pieces / num_random
+  if num_random == 0:
+    return 1.0
+
+  return 1.0 - (1.0 - __sample_confidence) ** (1.0 / num_random)
+
+def print_sample_summary(torrent, sample, bad_random_pieces):
+  bad_fraction = get_sample_bad_fraction(sample, bad_random_pieces)
+  print('Sample seed         : {0}'.format(sample.seed))
+  print('Pieces sampled      : {0:12,} ({1:.2f}% of pieces)'.format(
+    len(sample.pieces_list), 100.0 * len(sample.pieces_list) / max(1, torrent.num_pieces)))
+  print('Random pieces       : {0:12,} of {1:,}'.format(len(sample.random_set), sample.population))
+  print('Bad random pieces   : {0:12,}'.format(bad_random_pieces))
+  if len(sample.random_set) == sample.population:
+    print('Bad pieces estimate : {0:11.2f}% (all pieces checked)'.format(100.0 * bad_fraction))
+  elif bad_random_pieces == 0:
+    print('Bad pieces estimate : {0:11.2f}% at most, {1:.0f}% confidence'.format(
+      100.0 * bad_fraction, 100.0 * __sample_confidence))
+  else:
+    print('Bad pieces estimate : {0:11.2f}% of pieces'.format(100.0 * bad_fraction))
+
+# Checks a sample of the pieces of the torrent
+def check_torrent_files_sample(torrent, sample_size):
+  sample = get_pieces_sample(torrent, sample_size, __prog_options_sampleSeed)
+  print('Checking a sample of {0:,} pieces out of {1:,}'.format(len(sample.pieces_list), torrent.num_pieces))
+
+  return report_torrent_hash_check(torrent, sample.pieces_list, range(torrent.num_files), sample)
+
+# --- BitTorrent v2 verification ---
+# v2 torrents (BEP 52) hash every file on its own with a SHA-256 Merkle tree
+# of 16 KiB blocks. The piece layer of the tree is stored in the torrent for
+# files bigger than a piece, the root for all of them. Pieces never cross
+# file boundaries, so bad pieces are located to one file, a file is checked
+# reading only that file, and pieces of all files are hashed in parallel by
+# the --jobs pool.
+__v2_block_size = 16 * 1024
+__v2_pieces_per_task = 16
+
+# Hasher-like object that builds the Merkle tree of the data fed with
+# update(). digest() returns the root of a tree of num_leaves leaves, leaves
+# past the end of the data are zero.
+class MerkleHasher:
+  block_size = 16 * 1024
+
+  def __init__(self, num_leaves, run_stats=None):
+    self.num_leaves = num_leaves
+    self.leaf_list = []
+    self.block_hasher = hashlib.sha256()
+    self.block_used = 0
+    self.run_stats = run_stats
+
+  def update(self, data):
+    start_time = time.perf_counter()
+    data = memoryview(data)
+    while len(data) > 0:
+      num_bytes = min(len(data), self.block_size - self.block_used)
+      self.block_hasher.update(data[:num_bytes])
+      self.block_used += num_bytes
+      data = data[num_bytes:]
+      if self.block_used == self.block_size:
+        self.leaf_list.append(self.block_hasher.digest())
+        self.block_hasher = hashlib.sha256()
+        self.block_used = 0
+    if self.run_stats is not None:
+      self.run_stats.add_time('hash', time.perf_counter() - start_time)
+
+  def digest(self):
+    start_time = time.perf_counter()
+    leaf_list = self.leaf_list
+    if self.block_used > 0:
+      leaf_list = leaf_list + [self.block_hasher.digest()]
+    root = get_merkle_root(leaf_list, self.num_leaves, bytes(32))
+    if self.run_stats is not None:
+      self.run_stats.add_time('hash', time.perf_counter() - start_time)
+
+    return root
+
+# Returns the root of a Merkle tree with num_leaves leaves (a power of 2).
+# Leaves past the end of hash_list are pad_hash.
+def get_merkle_root(hash_list, num_leaves, pad_hash):
+  layer = list(hash_list) + [pad_hash] * (num_leaves - len(hash_list))
+  while len(layer) > 1:
+    layer = [hashlib.sha256(layer[i] + layer[i + 1]).digest() for i in range(0, len(layer), 2)]
+
+  return layer[0]
+
+def get_next_power_of_2(n):
+  return 1 << (n - 1).bit_length()
+
+# Returns the list of expected piece hashes of a v2 file, or None if the
+# piece layer is missing or does not match the pieces root. A file not
+# bigger than a piece has one piece whose hash is the pieces root.
+def get_v2_piece_hashes(torrent, file_idx):
+  pieces_root = torrent.v2_file_dict[file_idx]
+  file_length = torrent.file_length_list[file_idx]
+  if file_length <= torrent.piece_length:
+    return [pieces_root]
+  num_pieces = -(-file_length // torrent.piece_length)
+  piece_layer = torrent.piece_layers.get(pieces_root)
+  if piece_layer is None or len(piece_layer) != 32 * num_pieces:
+    return None
+  hash_list = [bytes(piece_layer[i:i + 32]) for i in range(0, len(piece_layer), 32)]
+  # Hash of a piece of zeros is the root of a subtree of zero leaves
+  pad_hash = bytes(32)
+  for i in range((torrent.piece_length // __v2_block_size).bit_length() - 1):
+    pad_hash = hashlib.sha256(pad_hash + pad_hash).digest()
+  if get_merkle_root(hash_list, get_next_power_of_2(num_pieces), pad_hash) != pieces_root:
+    return None
+
+  return hash_list
+
+# Hashes some pieces of a v2 file. Returns the list of bad pieces and the
+# number of pieces not read because the file already had a bad piece
+# (--perFileStop and --failFast).
+def hash_v2_pieces(torrent, file_idx, piece_hash_list, pieces_range):
+  path = torrent_file_path(torrent, file_idx)
+  file_length = torrent.file_length_list[file_idx]
+  piece_length = torrent.piece_length
+  bad_piece_list = []
+  num_skipped = 0
+  for piece_idx in pieces_range:
+    if file_idx in torrent.stopped_file_set:
+      num_skipped += 1
+      continue
+    piece_start = piece_idx * piece_length
+    piece_end = min(file_length, piece_start + piece_length)
+    if file_length <= piece_length:
+      hasher = MerkleHasher(get_next_power_of_2(-(-file_length // __v2_block_size)), __run_stats)
+    else:
+      hasher = MerkleHasher(piece_length // __v2_block_size, __run_stats)
+    if __read_semaphore is None:
+      feed_file(hasher, path, piece_start, piece_end)
+    else:
+      with __read_semaphore:
+        feed_file(hasher, path, piece_start, piece_end)
+    if hasher.digest() != piece_hash_list[piece_idx]:
+      bad_piece_list.append(piece_idx)
+      if __prog_options_perFileStop or __prog_options_failFast:
+        torrent.stopped_file_set.add(file_idx)
+
+  return (bad_piece_list, num_skipped)
+
+# Returns the bytes of the checked pieces of a v2 file. Skipped pieces are
+# counted as whole pieces.
+def get_v2_checked_bytes(torrent, file_idx, num_skipped):
+  return max(0, torrent.file_length_list[file_idx] - num_skipped * torrent.piece_length)
+
+# Yields (file_idx, hash_status, num_pieces, bad_piece_list, num_skipped)
+# for the v2 files in file_idx_list, in that order. hash_status is VERIFIED, BAD_SHA or
+# BAD_LAYER if the torrent has no valid piece layer for the file. Missing
+# and short files are not read, all their pieces are bad.
+def v2_checked_files_generator(torrent, file_idx_list):
+  num_jobs = __prog_options_jobs
+  executor = get_hash_executor() if num_jobs > 1 else None
+  pending = deque() # (file_idx, num_pieces, result) where result is a list of futures
+  num_pending_tasks = 0
+  try:
+    for file_idx in file_idx_list:
+      file_length = torrent.file_length_list[file_idx]
+      num_pieces = -(-file_length // torrent.piece_length)
+      if num_pieces == 0:
+        pending.append((file_idx, 0, 'VERIFIED', ([], 0)))
+      elif is_zero_file(torrent, file_idx):
+        pending.append((file_idx, num_pieces, 'BAD_SHA', (list(range(num_pieces)), 0)))
       else:
-        if __debug_file_location_in_torrent:
-          print('UNMATCHED  {0}'.format(file_name))
-
-  # DEBUG info
-  print('File           {0}'.format(fileName))
-  print('Internal name  {0}'.format(fileName_search))
-  print('File spans {0} pieces'.format(len(pieces_list)))
-  if __debug_file_location_in_torrent:
-    print('List of pieces')
-    for i in range(len(pieces_list)):
-      print(' #{0:6}'.format(pieces_list[i]))
-
-  if len(pieces_list) < 1:
-    print('ERROR File not found in torrent list of files. Exiting.')
-    sys.exit(1)
+        piece_hash_list = get_v2_piece_hashes(torrent, file_idx)
+        if piece_hash_list is None:
+          pending.append((file_idx, num_pieces, 'BAD_LAYER', (list(range(num_pieces)), 0)))
+        elif executor is None:
+          hash_result = hash_v2_pieces(torrent, file_idx, piece_hash_list, range(num_pieces))
+          pending.append((file_idx, num_pieces, None, hash_result))
+        else:
+          future_list = []
+          for first_piece in range(0, num_pieces, __v2_pieces_per_task):
+            pieces_range = range(first_piece, min(num_pieces, first_piece + __v2_pieces_per_task))
+            future_list.append(executor.submit(hash_v2_pieces, torrent, file_idx, piece_hash_list, pieces_range))
+          num_pending_tasks += len(future_list)
+          pending.append((file_idx, num_pieces, None, future_list))
+      # Yield finished files in order while too many tasks are queued
+      while pending and (executor is None or num_pending_tasks > 2 * num_jobs):
+        file_idx, num_pieces, hash_status, result = pending.popleft()
+        yield get_v2_file_result(file_idx, num_pieces, hash_status, result)
+        if hash_status is None and executor is not None:
+          num_pending_tasks -= len(result)
+    while pending:
+      file_idx, num_pieces, hash_status, result = pending.popleft()
+      yield get_v2_file_result(file_idx, num_pieces, hash_status, result)
+      if hash_status is None and executor is not None:
+        num_pending_tasks -= len(result)
+  finally:
+    for file_idx, num_pieces, hash_status, result in pending:
+      if hash_status is None and executor is not None:
+        for future in result:
+          future.cancel()
+    __file_handle_cache.close_all()
+    __mmap_cache.close_all()
+
+# result is a (bad_piece_list, num_skipped) tuple or a list of futures of
+# them.
+def get_v2_file_result(file_idx, num_pieces, hash_status, result):
+  if hash_status is not None:
+    return (file_idx, hash_status, num_pieces) + result
+  if isinstance(result, list):
+    bad_piece_list = []
+    num_skipped = 0
+    for future in result:
+      task_bad_piece_list, task_skipped = future.result()
+      bad_piece_list.extend(task_bad_piece_list)
+      num_skipped += task_skipped
+  else:
+    bad_piece_list, num_skipped = result
 
-  # --- Check pieces in list only
-  print('piece#  file# HStatus  FStatus     Actual Bytes    Torrent Bytes  File name')
-  print('------ ------ -------- -------- ---------------- ----------------  --------------')
-  piece_counter = 0
-  good_pieces = 0
-  bad_pieces = 0
-  for piece, file_idx_list, piece_index in pieces_generator(torrent, pieces_list):
-    # --- Compare piece hash with expected hash
-    piece_hash = hashlib.sha1(piece).digest()
-    if piece_hash != torrent.pieces_hash_list[piece_index]:
-      hash_status = 'BAD_SHA'
-      bad_pieces += 1
-      ret_value = 1
-    else:
-      hash_status = 'GOOD_SHA'
-      good_pieces += 1
+  return (file_idx, 'BAD_SHA' if bad_piece_list else 'VERIFIED', num_pieces, bad_piece_list, num_skipped)
 
-    # --- Print information
-    for i in range(len(file_idx_list)):
-      file_idx = file_idx_list[i]
-      path = os.path.join(torrent.dir_data, torrent.file_name_list[file_idx])
-      file_exists = os.path.isfile(path)
-      if file_exists:
-        file_size = os.path.getsize(path)
-        if file_size == torrent.file_length_list[file_idx]:
-          file_status = 'OK'
-        else:
-          file_status = 'BAD_SIZE'
-          ret_value = 1
-      else:
-        file_size = -1
-        file_status = 'MISSING'
-        ret_value = 1
-      # --- Print odd/even pieces with different colors
-      text_size = 7+7+9+9+17+17+1
-      if piece_index % 2:
-        print('{0:06d} {1:6} {2:>8} {3:>8} {4:16,} {5:16,}  {6}'
-          .format(piece_index+1, file_idx+1, hash_status, file_status, 
-                  file_size, torrent.file_length_list[file_idx], 
-                  limit_string_lentgh(torrent.file_name_list[file_idx], __cols -text_size)))
+# Checks the v2 files in file_idx_list and reports them
+def report_torrent_v2_check(torrent, file_idx_list):
+  ret_value = 0
+  take_file_stat_snapshot(torrent)
+  report_format = __prog_options_format
+  print('Checking files with BitTorrent v2 SHA-256 Merkle trees')
+  if report_format != 'jsonl':
+    __report_output.write_line(' file#  FStatus   HStatus       Pieces   Bad pieces  File name')
+    __report_output.write_line('------ -------- --------- ------------ ------------  --------------')
+  progress = None
+  if __prog_options_progress:
+    progress = ProgressLine(sum(torrent.file_length_list[file_idx] for file_idx in file_idx_list))
+  num_files_OK = num_files_bigger_size = num_files_smaller_size = num_files_missing = 0
+  num_files_verified = num_files_bad_pieces = 0
+  num_pieces_checked = good_pieces = bad_pieces = skipped_pieces = 0
+  bytes_checked = 0
+  fail_fast_stop = False
+  text_size = 7+9+10+13+13+1
+  v2_file_idx_list = [file_idx for file_idx in file_idx_list if file_idx not in torrent.pad_file_set]
+  first_piece_list = get_v2_first_piece_list(torrent)
+  torrent.have_pieces = bytearray(first_piece_list[-1])
+  checked_files = v2_checked_files_generator(torrent, v2_file_idx_list)
+  for file_idx, hash_status, num_pieces, bad_piece_list, num_skipped in checked_files:
+    file_status, file_size = get_file_status(torrent, file_idx)
+    # Pieces of files with skipped pieces are left as not checked
+    if num_skipped == 0:
+      first_piece = first_piece_list[file_idx]
+      torrent.have_pieces[first_piece:first_piece + num_pieces] = bytes([1]) * num_pieces
+      for piece_idx in bad_piece_list:
+        torrent.have_pieces[first_piece + piece_idx] = 0
+    num_pieces_checked += num_pieces - num_skipped
+    bytes_checked += get_v2_checked_bytes(torrent, file_idx, num_skipped)
+    bad_pieces += len(bad_piece_list)
+    good_pieces += num_pieces - num_skipped - len(bad_piece_list)
+    skipped_pieces += num_skipped
+    # Closing the generator ends the loop after this file is reported
+    if bad_piece_list and __prog_options_failFast:
+      fail_fast_stop = True
+      checked_files.close()
+    if progress is not None:
+      progress.num_pieces += num_pieces - 1
+      progress.update(torrent.file_length_list[file_idx])
+    if file_status == 'OK':
+      num_files_OK += 1
+    elif file_status == 'BAD_SIZE':
+      if file_size > torrent.file_length_list[file_idx]:
+        num_files_bigger_size += 1
       else:
-        print('\033[0;97m{0:06d} {1:6} {2:>8} {3:>8} {4:16,} {5:16,}  {6}\033[0m'
-          .format(piece_index+1, file_idx+1, hash_status, file_status, 
-                  file_size, torrent.file_length_list[file_idx], 
-                  limit_string_lentgh(torrent.file_name_list[file_idx], __cols -text_size)))
-    # --- Increment piece counter
-    piece_counter += 1
+        num_files_smaller_size += 1
+    else:
+      num_files_missing += 1
+    if hash_status == 'VERIFIED':
+      if file_status == 'OK':
+        num_files_verified += 1
+    else:
+      num_files_bad_pieces += 1
+    if file_status != 'OK' or hash_status != 'VERIFIED':
+      ret_value = 1
+    elif not __prog_options_allPieces:
+      continue
+
+    # --- Print file result
+    start_time = time.perf_counter()
+    if report_format == 'jsonl':
+      __report_output.write_line(json.dumps({'type' : 'file', 'file' : file_idx+1,
+        'status' : file_status, 'hash_status' : hash_status, 'size' : file_size,
+        'length' : torrent.file_length_list[file_idx], 'pieces' : num_pieces,
+        'skipped_pieces' : num_skipped,
+        'bad_pieces' : len(bad_piece_list), 'bad_piece_list' : bad_piece_list,
+        'name' : torrent.file_name_list[file_idx]}))
+    else:
+      __report_output.write_line('{0:6} {1:>8} {2:>9} {3:12,} {4:12,}  {5}'.format(
+        file_idx+1, file_status, hash_status, num_pieces, len(bad_piece_list),
+        limit_string_lentgh(torrent.file_name_list[file_idx], __cols -text_size)))
+    add_run_time('output', start_time)
+  if progress is not None:
+    progress.finish()
+  if __run_stats is not None:
+    __run_stats.add_pieces(num_pieces_checked, bytes_checked)
+
+  # --- Print summary
+  if report_format == 'jsonl':
+    __report_output.write_line(json.dumps({'type' : 'summary',
+      'torrent' : torrent.torrent_file, 'info_hash' : torrent.info_hash,
+      'info_hash_v2' : torrent.info_hash_v2, 'meta_version' : 2,
+      'piece_length' : torrent.piece_length,
+      'files' : torrent.num_files, 'total_bytes' : torrent.total_bytes,
+      'data_directory' : torrent.dir_data,
+      'files_ok' : num_files_OK, 'files_bigger' : num_files_bigger_size,
+      'files_smaller' : num_files_smaller_size, 'files_missing' : num_files_missing,
+      'files_verified' : num_files_verified, 'files_bad_pieces' : num_files_bad_pieces,
+      'pieces_checked' : num_pieces_checked, 'good_pieces' : good_pieces,
+      'bad_pieces' : bad_pieces}))
+    if __prog_options_failFast or __prog_options_perFileStop:
+      __report_output.write_line(json.dumps({'type' : 'stop', 'fail_fast_stop' : fail_fast_stop,
+        'skipped_pieces' : skipped_pieces}))
+    __report_output.flush()
+    return ret_value
+  __report_output.flush()
 
-  # --- Print torrent metadata
   print('')
   print('Torrent file        : {0}'.format(torrent.torrent_file))
-  print('Pieces info         : {0:10,} pieces, {1:16,} bytes/piece'.format(torrent.num_pieces, torrent.piece_length))
+  print('Info hash v2        : {0}'.format(torrent.info_hash_v2))
+  print('Pieces info         : {0:16,} bytes/piece'.format(torrent.piece_length))
   print('Files info          : {0:10,} files,  {1:16,} total bytes'.format(torrent.num_files, torrent.total_bytes))
   print('Torrent directory   : {0}'.format(torrent.dir_name))
   print('Download directory  : {0}'.format(torrent.dir_download))
   print('Data directory      : {0}'.format(torrent.dir_data))
-  print('# of pieces checked : {0:12,}'.format(piece_counter))
+  print('Files OK            : {0:12,}'.format(num_files_OK))
+  print('Files w big size    : {0:12,}'.format(num_files_bigger_size))
+  print('Files w small size  : {0:12,}'.format(num_files_smaller_size))
+  print('Files missing       : {0:12,}'.format(num_files_missing))
+  print('Files verified      : {0:12,}'.format(num_files_verified))
+  print('Files w bad pieces  : {0:12,}'.format(num_files_bad_pieces))
+  print('# of pieces checked : {0:12,}'.format(num_pieces_checked))
   print('Good pieces         : {0:12,}'.format(good_pieces))
   print('Bad pieces          : {0:12,}'.format(bad_pieces))
+  if __prog_options_perFileStop:
+    print('Pieces skipped      : {0:12,}'.format(skipped_pieces))
+  if fail_fast_stop:
+    print('Stopped at the first bad piece (--failFast)')
+
+  return ret_value
+
+# Returns the index of the first piece of every file in the torrent, plus
+# the number of pieces at the end. Files of v2 torrents start at a piece
+# boundary, hybrid torrents align them with pad files.
+def get_v2_first_piece_list(torrent):
+  piece_length = torrent.piece_length
+  if torrent.num_pieces > 0:
+    return [-(-file_offset // piece_length) for file_offset in torrent.file_offset_list[:-1]] + \
+           [torrent.num_pieces]
+  first_piece_list = [0]
+  for file_length in torrent.file_length_list:
+    first_piece_list.append(first_piece_list[-1] + -(-file_length // piece_length))
+
+  return first_piece_list
+
+# v2 only torrents are always checked with the v2 hashes, hybrid ones with
+# --v2
+def use_v2_hash(torrent):
+  return torrent.meta_version == 2 and (torrent.num_pieces == 0 or __prog_options_v2)
+
+# Returns a dictionary of torrent internal file name -> file index
+def get_file_index_dict(torrent):
+  file_index_dict = {}
+  for file_idx in range(torrent.num_files):
+    file_index_dict[torrent.file_name_list[file_idx]] = file_idx
+
+  return file_index_dict
+
+# Checks single files against SHA1 hash for integrity. Pieces shared by
+# several files of the list are checked only once.
+__debug_file_location_in_torrent = 0
+def check_torrent_files_single_hash(torrent, fileName_list):
+  dir_data = torrent.dir_data
+  file_index_dict = get_file_index_dict(torrent)
+  pieces_set = set()
+  file_idx_set = set()
+  num_files_not_found = 0
+  for fileName in fileName_list:
+    # Remove torrent download directory from path
+    fileName_search = fileName.replace(dir_data, '');
+    fileName_search = fileName_search.strip('/')
+
+    if __debug_file_location_in_torrent:
+      print('dir_data         {0}'.format(dir_data))
+      print('fileName         {0}'.format(fileName))
+      print('fileName_search  {0}'.format(fileName_search))
+
+    # Locate which pieces of the torrent this file spans. v2 pieces are
+    # counted inside the file.
+    file_pieces = range(0)
+    if fileName_search in file_index_dict:
+      file_idx = file_index_dict[fileName_search]
+      if use_v2_hash(torrent):
+        file_pieces = range(-(-torrent.file_length_list[file_idx] // torrent.piece_length))
+        file_idx_set.add(file_idx)
+      else:
+        file_pieces = get_file_pieces(torrent, file_idx)
+        pieces_set.update(file_pieces)
+
+    # DEBUG info
+    print('File           {0}'.format(fileName))
+    print('Internal name  {0}'.format(fileName_search))
+    print('File spans {0} pieces'.format(len(file_pieces)))
+    if __debug_file_location_in_torrent:
+      print('List of pieces')
+      for piece_idx in file_pieces:
+        print(' #{0:6}'.format(piece_idx))
+
+    if fileName_search not in file_index_dict or (len(file_pieces) < 1 and not use_v2_hash(torrent)):
+      print('ERROR File not found in torrent list of files.')
+      num_files_not_found += 1
+
+  if num_files_not_found > 0:
+    print('ERROR {0} files not found in torrent list of files. Exiting.'.format(num_files_not_found))
+    sys.exit(1)
+  if use_v2_hash(torrent):
+    return report_torrent_v2_check(torrent, sorted(file_idx_set))
+  pieces_list = sorted(pieces_set)
+
+  # --- Check pieces in list only
+  checked_file_idx_set = set()
+  for piece_idx in pieces_list:
+    for file_idx, file_start, file_end in get_piece_files(torrent, piece_idx):
+      checked_file_idx_set.add(file_idx)
+
+  return report_torrent_hash_check(torrent, pieces_list, sorted(checked_file_idx_set))
+
+# --- Fast resume ---
+# --writeResume writes the result of --checkHash as a libtorrent resume file
+# so the client adds the torrent with the verified pieces and does not hash
+# them again. pieces has one byte per piece, bit 0 set if the piece is good.
+# file sizes (size, mtime) is used by older libtorrent versions to detect
+# files changed after the resume file was written.
+def get_resume_data(torrent):
+  file_size_list = []
+  for file_idx in range(torrent.num_files):
+    file_stat = torrent.file_stat_list[file_idx]
+    if file_idx in torrent.pad_file_set or not file_stat.exists:
+      file_size_list.append([0, 0])
+    else:
+      file_size_list.append([file_stat.size, file_stat.mtime_ns // 1000000000])
+  if torrent.dir_name is None:
+    name = torrent.file_name_list[0]
+  else:
+    name = torrent.dir_name
+  now = int(time.time())
+  resume = {
+    'file-format'    : 'libtorrent resume file',
+    'file-version'   : 1,
+    'name'           : name,
+    'save_path'      : os.path.abspath(torrent.dir_download),
+    'pieces'         : bytes(torrent.have_pieces),
+    'file sizes'     : file_size_list,
+    'allocation'     : 'sparse',
+    'seed_mode'      : 0,
+    'added_time'     : now,
+    'completed_time' : now if all(torrent.have_pieces) else 0
+  }
+  if torrent.num_pieces > 0:
+    resume['info-hash'] = bytes.fromhex(torrent.info_hash)
+  if torrent.info_hash_v2 is not None:
+    resume['info-hash2'] = bytes.fromhex(torrent.info_hash_v2)
+  # With --otd files are not in the torrent directory, rename them
+  if torrent.dir_name is not None and torrent.dir_data == torrent.dir_download:
+    resume['mapped_files'] = list(torrent.file_name_list)
+
+  return resume
+
+def write_resume_file(torrent, resume_file_name):
+  data = Encoder().encode(get_resume_data(torrent))
+  temp_name = resume_file_name + '.tmp'
+  with open(temp_name, 'wb') as resume_file:
+    resume_file.write(data)
+  os.replace(temp_name, resume_file_name)
+  print('Resume file         : {0}'.format(resume_file_name))
+
+# --- Batch mode ---
+# Checks a whole library of torrents in one run. Torrents share the hashing
+# threads, the open file cache and the --maxReads limit. Only a summary line
+# is printed for every torrent.
+BatchResult = namedtuple('BatchResult', ['status', 'ret_value', 'num_files', 'bad_files',
+                                         'num_pieces', 'bad_pieces'])
+
+# Returns the list of torrent files in a directory (recursively) or in a
+# manifest file with one torrent file per line.
+def get_batch_torrent_list(batch_path):
+  torrent_list = []
+  if os.path.isdir(batch_path):
+    for root, dirs, files in os.walk(batch_path):
+      for name in files:
+        if name.endswith('.torrent'):
+          torrent_list.append(os.path.join(root, name))
+    torrent_list.sort()
+  else:
+    with open(batch_path, 'r') as manifest:
+      for line in manifest:
+        line = line.strip()
+        if line and not line.startswith('#'):
+          torrent_list.append(line)
+
+  return torrent_list
+
+# Checks a torrent of a batch. Status can be: OK, BAD, NOTFOUND (torrent file
+# not found), NODATA (data directory not found), ERROR (bad torrent file or a
+# data file that cannot be read). ret_value follows the program return codes.
+def batch_check_torrent(torrentFileName, data_directory, check_hash):
+  if not os.path.isfile(torrentFileName):
+    return BatchResult('NOTFOUND', 3, 0, 0, 0, 0)
+  try:
+    torrent = extract_torrent_metadata(torrentFileName, quiet=True)
+  except (DecodingError, OSError, KeyError, ValueError, AttributeError, TypeError):
+    return BatchResult('ERROR', 1, 0, 0, 0, 0)
+  set_torrent_data_directory(torrent, data_directory)
+  if not os.path.isdir(torrent.dir_data):
+    return BatchResult('NODATA', 4, torrent.num_files, 0, 0, 0)
+  # An unreadable data file fails this torrent only, not the whole batch
+  try:
+    return batch_check_torrent_data(torrent, check_hash)
+  except OSError:
+    return BatchResult('ERROR', 1, torrent.num_files, 0, 0, 0)
+
+# Stats and hashes the data files of a torrent of a batch
+def batch_check_torrent_data(torrent, check_hash):
+  ret_value = 0
+  take_file_stat_snapshot(torrent)
+  bad_files = 0
+  for file_idx in range(torrent.num_files):
+    file_status, file_size = get_file_status(torrent, file_idx)
+    if file_status not in ('OK', 'PAD'):
+      bad_files += 1
+      ret_value = 1
+  num_pieces = bad_pieces = bytes_checked = 0
+  if check_hash and use_v2_hash(torrent):
+    v2_file_idx_list = [file_idx for file_idx in range(torrent.num_files) if file_idx not in torrent.pad_file_set]
+    for file_idx, hash_status, file_pieces, bad_piece_list, num_skipped in v2_checked_files_generator(torrent, v2_file_idx_list):
+      num_pieces += file_pieces - num_skipped
+      bytes_checked += get_v2_checked_bytes(torrent, file_idx, num_skipped)
+      bad_pieces += len(bad_piece_list)
+      if bad_piece_list:
+        ret_value = 1
+        if __prog_options_failFast:
+          break
+    if __run_stats is not None:
+      __run_stats.add_pieces(num_pieces, bytes_checked)
+  elif check_hash:
+    for hash_status, file_idx_list, piece_idx in checked_pieces_generator(torrent):
+      if hash_status == 'SKIPPED':
+        continue
+      num_pieces += 1
+      bytes_checked += get_piece_size(torrent, piece_idx)
+      if hash_status == 'BAD_SHA':
+        bad_pieces += 1
+        ret_value = 1
+        if __prog_options_perFileStop:
+          torrent.stopped_file_set.update(file_idx_list)
+        if __prog_options_failFast:
+          break
+    if __run_stats is not None:
+      __run_stats.add_pieces(num_pieces, bytes_checked)
+  status = 'OK' if ret_value == 0 else 'BAD'
+
+  return BatchResult(status, ret_value, torrent.num_files, bad_files, num_pieces, bad_pieces)
+
+# Returns the maximum of the return values of all torrents
+def check_torrent_batch(batch_path, data_directory, check_hash, num_batch_jobs):
+  torrent_list = get_batch_torrent_list(batch_path)
+  if check_hash:
+    print('Checking {0:,} torrents (files, sizes and hash)'.format(len(torrent_list)))
+  else:
+    print('Checking {0:,} torrents (files and sizes, NOT hash)'.format(len(torrent_list)))
+  print('  Status     Files  Bad files       Pieces   Bad pieces  Torrent file')
+  print('-------- --------- ---------- ------------ ------------  --------------')
+  check_function = lambda torrentFileName: batch_check_torrent(torrentFileName, data_directory, check_hash)
+  if num_batch_jobs > 1:
+    batch_executor = ThreadPoolExecutor(max_workers=num_batch_jobs)
+    result_iterator = batch_executor.map(check_function, torrent_list)
+  else:
+    result_iterator = map(check_function, torrent_list)
+
+  ret_value = 0
+  status_count = {}
+  total_bad_pieces = 0
+  text_size = 9+10+11+13+13+2
+  for torrentFileName, result in zip(torrent_list, result_iterator):
+    print('{0:>8} {1:9,} {2:10,} {3:12,} {4:12,}  {5}'
+      .format(result.status, result.num_files, result.bad_files, result.num_pieces,
+              result.bad_pieces, limit_string_lentgh(torrentFileName, __cols -text_size)))
+    ret_value = max(ret_value, result.ret_value)
+    status_count[result.status] = status_count.get(result.status, 0) + 1
+    total_bad_pieces += result.bad_pieces
+  if num_batch_jobs > 1:
+    batch_executor.shutdown()
+
+  # --- Print batch summary
+  print('')
+  print('Download directory  : {0}'.format(data_directory))
+  print('Torrents checked    : {0:12,}'.format(len(torrent_list)))
+  print('Torrents OK         : {0:12,}'.format(status_count.get('OK', 0)))
+  print('Torrents with errors: {0:12,}'.format(status_count.get('BAD', 0)))
+  print('Torrents not found  : {0:12,}'.format(status_count.get('NOTFOUND', 0)))
+  print('Torrents w/o data   : {0:12,}'.format(status_count.get('NODATA', 0)))
+  print('Bad torrent or data : {0:12,}'.format(status_count.get('ERROR', 0)))
+  if check_hash:
+    print('Bad pieces          : {0:12,}'.format(total_bad_pieces))
+
+  return ret_value
+
+# Runs a check function. With --profile it runs under cProfile and the
+# profile is written to a file, which can be read with the pstats module.
+# Only the main thread is profiled. With --stats statistics are printed
+# after the check.
+def run_check(profile_option, check_function, *check_args):
+  if __run_stats is not None:
+    __run_stats.start_time = time.perf_counter()
+  if profile_option:
+    import cProfile
+    profiler = cProfile.Profile()
+    ret_value = profiler.runcall(check_function, *check_args)
+    profiler.dump_stats(profile_option[0])
+    print('Profile written to  : {0}'.format(profile_option[0]))
+  else:
+    ret_value = check_function(*check_args)
+  if __run_stats is not None:
+    print_run_stats(__run_stats)
 
   return ret_value
 
@@ -906,7 +3331,37 @@ are listed but no other action is performed.
 \033[35m--checkUnneeded\033[0m             Finds unneeded files in data directory.
 \033[35m--deleteUnneeded\033[0m            Deletes unneeded files in the data directory.
 \033[35m--checkHash\033[0m                 Checks Torrent data using SHA1 hash.
-\033[35m--checkFile\033[0m \033[31mfile\033[0m            Checks a single downloaded file against the SHA1 checksum.""")
+\033[35m--checkFile\033[0m \033[31mfile ...\033[0m        Checks downloaded files against the SHA1 checksum. Use - to
+                            read the list of files from standard input.
+\033[35m--checkSample\033[0m \033[31mN|P%\033[0m        Checks a random sample of N pieces or P% of the pieces, plus
+                            the first and last piece of every file.
+\033[35m--sampleSeed\033[0m \033[31mS\033[0m              Seed of the --checkSample random sample.
+\033[35m--writeResume\033[0m \033[31mfile\033[0m        Write a libtorrent resume file after --checkHash.
+\033[35m--failFast\033[0m                  Stop at the first bad piece.
+\033[35m--perFileStop\033[0m               Stop reading a file after its first bad piece.
+\033[35m--format\033[0m \033[31mFORMAT\033[0m             Report format: table (default), jsonl or summary.
+\033[35m--allPieces\033[0m                 Report all pieces and files, not only the bad ones.
+\033[35m--v2\033[0m                        Check hybrid torrents with the v2 SHA-256 hashes.
+\033[35m--unneededSizes\033[0m             Print sizes of unneeded files and directories.
+\033[35m--statJobs\033[0m \033[31mN\033[0m                Number of threads used to stat files.
+\033[35m--stats\033[0m                     Print time spent in every stage and throughput.
+\033[35m--progress\033[0m                  Show a progress line with ETA.
+\033[35m--profile\033[0m \033[31mfile.prof\033[0m         Write a cProfile profile of the check.
+\033[35m--jobs\033[0m \033[31mN\033[0m                    Number of threads used to read and hash pieces.
+\033[35m--prefetch\033[0m \033[31mK\033[0m                Read up to K buffers ahead of hashing in a reader thread.
+\033[35m--deviceJobs\033[0m \033[31mN\033[0m              Read every disk in parallel with N threads per disk.
+\033[35m--readOrder\033[0m \033[31mORDER\033[0m           Read pieces in logical, inode or physical order.
+\033[35m--bufferSize\033[0m \033[31mBYTES\033[0m          Size of read buffers (default 1 MiB).
+\033[35m--fadvise\033[0m                   Do not fill the page cache with verified data.
+\033[35m--directIO\033[0m                  Read files with O_DIRECT, bypassing the page cache.
+\033[35m--mmap\033[0m                      Hash pieces from memory mapped files.
+\033[35m--batch\033[0m \033[31mpath\033[0m                Check all torrents in a directory or manifest file.
+\033[35m--batchJobs\033[0m \033[31mN\033[0m               Number of torrents checked at the same time in batch mode.
+\033[35m--maxReads\033[0m \033[31mN\033[0m                Maximum number of pieces read at the same time.
+\033[35m--cacheResidency\033[0m            Report page cache residency before and after the check.
+\033[35m--noCache\033[0m                   Do not read or write the verification cache.
+\033[35m--cacheSize\033[0m \033[31mMiB\033[0m             Maximum size of the verification cache (default 1024).
+\033[35m--rehash\033[0m                    Ignore cached piece results and hash everything again.""")
 
 # -----------------------------------------------------------------------------
 # main function
@@ -918,88 +3373,281 @@ are listed but no other action is performed.
 # 3 torrent file does not found
 # 4 data directory not found
 # -----------------------------------------------------------------------------
-print('\033[36mTorrentVerify\033[0m' + ' version ' + __software_version)
-
-# --- Command line parser
-p = argparse.ArgumentParser()
-p.add_argument('-t', help="Torrent file", nargs = 1)
-p.add_argument("-d", help="Data directory", nargs = 1)
-p.add_argument("--otd", help="Override torrent directory", action="store_true")
-g = p.add_mutually_exclusive_group()
-g.add_argument("--check", help="Do a basic torrent check: files there or not and size", action="store_true")
-g.add_argument("--checkUnneeded", help="Write me", action="store_true")
-g.add_argument("--checkHash", help="Full check with SHA1 hash", action="store_true")
-g.add_argument("--checkFile", help="Check single file with SHA1 hash", nargs = 1)
-d = p.add_mutually_exclusive_group()
-d.add_argument("--deleteWrongSizeFiles", help="Delete files having wrong size", action="store_true")
-d.add_argument("--truncateWrongSizeFiles", help="Chop files with incorrect size to right one", action="store_true")
-p.add_argument("--deleteUnneeded", help="Write me", action="store_true")
-args = p.parse_args();
-
-# --- Read arguments
-torrentFileName = data_directory = None
-check = checkUnneeded = checkHash = 0
-
-if args.t:
-  torrentFileName = args.t[0];
-if args.d:
-  data_directory = args.d[0];
-  
-# Optional arguments
-if args.otd:
-  __prog_options_override_torrent_dir = 1
-
-if args.deleteWrongSizeFiles:
-  __prog_options_deleteWrongSizeFiles = 1
-
-if args.truncateWrongSizeFiles:
-  __prog_options_truncateWrongSizeFiles = 1
-
-if args.deleteUnneeded:
-  __prog_options_deleteUnneeded = 1
-
-# --- Extrant torrent metadata
-if not torrentFileName:
-  do_printHelp()
-  sys.exit(2)
-
-if (args.check or args.checkUnneeded or args.checkHash or args.checkFile) \
-    and data_directory == None:
-  do_printHelp()
-  sys.exit(2)
-
-# --- Check for torrent file existence
-if not os.path.isfile(torrentFileName):
-  print('Torrent file not found: {0}'.format(torrentFileName))
-  sys.exit(3)
-
-# --- Read torrent file metadata  
-torrent_obj = extract_torrent_metadata(torrentFileName)
+if __name__ == '__main__':
+  # --- Command line parser
+  p = argparse.ArgumentParser()
+  p.add_argument('-t', help="Torrent file", nargs = 1)
+  p.add_argument("-d", help="Data directory", nargs = 1)
+  p.add_argument("--otd", help="Override torrent directory", action="store_true")
+  g = p.add_mutually_exclusive_group()
+  g.add_argument("--check", help="Do a basic torrent check: files there or not and size", action="store_true")
+  g.add_argument("--checkUnneeded", help="Write me", action="store_true")
+  g.add_argument("--checkHash", help="Full check with SHA1 hash", action="store_true")
+  g.add_argument("--checkFile", help="Check files with SHA1 hash (- reads list from stdin)", nargs = '+')
+  g.add_argument("--checkSample", help="Check a sample of N pieces or P%% of the pieces with SHA1 hash", nargs = 1)
+  d = p.add_mutually_exclusive_group()
+  d.add_argument("--deleteWrongSizeFiles", help="Delete files having wrong size", action="store_true")
+  d.add_argument("--truncateWrongSizeFiles", help="Chop files with incorrect size to right one", action="store_true")
+  p.add_argument("--deleteUnneeded", help="Write me", action="store_true")
+  j = p.add_mutually_exclusive_group()
+  j.add_argument("--jobs", help="Number of threads to hash pieces", type=int, nargs = 1)
+  j.add_argument("--prefetch", help="Number of buffers read ahead of hashing", type=int, nargs = 1)
+  j.add_argument("--deviceJobs", help="Number of reader threads per disk", type=int, nargs = 1)
+  p.add_argument("--format", help="Report format of --checkHash and --checkFile", choices=['table', 'jsonl', 'summary'], nargs = 1)
+  p.add_argument("--allPieces", help="Report all pieces and files, not only the bad ones", action="store_true")
+  p.add_argument("--writeResume", help="Write a libtorrent resume file after --checkHash", nargs = 1)
+  p.add_argument("--failFast", help="Stop at the first bad piece", action="store_true")
+  p.add_argument("--perFileStop", help="Stop reading a file after its first bad piece", action="store_true")
+  p.add_argument("--sampleSeed", help="Seed of the random sample of --checkSample", nargs = 1)
+  p.add_argument("--v2", help="Check hybrid torrents with the BitTorrent v2 SHA-256 hashes", action="store_true")
+  p.add_argument("--unneededSizes", help="Print sizes of unneeded files and directories", action="store_true")
+  p.add_argument("--statJobs", help="Number of threads used to stat files", type=int, nargs = 1)
+  p.add_argument("--stats", help="Print time spent in every stage and throughput", action="store_true")
+  p.add_argument("--progress", help="Show a progress line with ETA", action="store_true")
+  p.add_argument("--profile", help="Write a cProfile profile of the check to a file", nargs = 1)
+  p.add_argument("--readOrder", help="Order pieces are read in", choices=['logical', 'inode', 'physical'], nargs = 1)
+  p.add_argument("--bufferSize", help="Size of read buffers in bytes", type=int, nargs = 1)
+  p.add_argument("--fadvise", help="Do not fill the page cache with verified data", action="store_true")
+  r = p.add_mutually_exclusive_group()
+  r.add_argument("--directIO", help="Read files with O_DIRECT bypassing the page cache", action="store_true")
+  r.add_argument("--mmap", help="Hash pieces from memory mapped files", action="store_true")
+  p.add_argument("--cacheResidency", help="Report page cache residency before and after the check", action="store_true")
+  p.add_argument("--batch", help="Directory or manifest of torrent files to check", nargs = 1)
+  p.add_argument("--batchJobs", help="Number of torrents checked at the same time in batch mode", type=int, nargs = 1)
+  p.add_argument("--maxReads", help="Maximum number of pieces read at the same time", type=int, nargs = 1)
+  c = p.add_mutually_exclusive_group()
+  c.add_argument("--noCache", help="Do not use the verification cache", action="store_true")
+  p.add_argument("--cacheSize", help="Maximum size of the verification cache in MiB", type=int, nargs = 1)
+  c.add_argument("--rehash", help="Ignore cached results and hash all pieces again", action="store_true")
+  args = p.parse_args();
+
+  # With --format jsonl standard output only has the JSON report, the rest of
+  # messages go to standard error.
+  if args.format:
+    __prog_options_format = args.format[0]
+  if __prog_options_format == 'jsonl':
+    sys.stdout = sys.stderr
+  print('\033[36mTorrentVerify\033[0m' + ' version ' + __software_version)
+
+  # --- Read arguments
+  torrentFileName = data_directory = None
+  check = checkUnneeded = checkHash = 0
+
+  if args.t:
+    torrentFileName = args.t[0];
+  if args.d:
+    data_directory = args.d[0];
+
+  # Optional arguments
+  if args.otd:
+    __prog_options_override_torrent_dir = 1
+
+  if args.deleteWrongSizeFiles:
+    __prog_options_deleteWrongSizeFiles = 1
+
+  if args.truncateWrongSizeFiles:
+    __prog_options_truncateWrongSizeFiles = 1
+
+  if args.deleteUnneeded:
+    __prog_options_deleteUnneeded = 1
+
+  if args.jobs:
+    if args.jobs[0] < 1:
+      print('Number of jobs must be 1 or more')
+      sys.exit(2)
+    __prog_options_jobs = args.jobs[0]
+
+  if args.prefetch:
+    if args.prefetch[0] < 1:
+      print('Number of prefetch buffers must be 1 or more')
+      sys.exit(2)
+    __prog_options_prefetch = args.prefetch[0]
+
+  if args.deviceJobs:
+    if args.deviceJobs[0] < 1:
+      print('Number of jobs per device must be 1 or more')
+      sys.exit(2)
+    __prog_options_deviceJobs = args.deviceJobs[0]
+
+  if args.allPieces:
+    __prog_options_allPieces = 1
+
+  if args.v2:
+    __prog_options_v2 = 1
+
+  if args.sampleSeed:
+    __prog_options_sampleSeed = args.sampleSeed[0]
+
+  if args.failFast:
+    __prog_options_failFast = 1
+
+  if args.perFileStop:
+    __prog_options_perFileStop = 1
+
+  if args.unneededSizes:
+    __prog_options_unneededSizes = 1
+
+  if args.statJobs:
+    if args.statJobs[0] < 1:
+      print('Number of stat jobs must be 1 or more')
+      sys.exit(2)
+    __prog_options_statJobs = args.statJobs[0]
+
+  if args.stats:
+    __run_stats = RunStats()
+    pread_into = timed_pread_into
+
+  if args.progress:
+    __prog_options_progress = 1
+
+  if args.readOrder:
+    __prog_options_readOrder = args.readOrder[0]
+
+  if args.bufferSize:
+    if args.bufferSize[0] < 4096:
+      print('Buffer size must be 4096 bytes or more')
+      sys.exit(2)
+    __read_block_size = args.bufferSize[0]
+    __zero_block = bytes(__read_block_size)
+
+  if args.fadvise:
+    if not hasattr(os, 'posix_fadvise'):
+      print('--fadvise is not supported on this platform')
+      sys.exit(2)
+    __prog_options_fadvise = 1
+    # mincore() tells which pages were cached when a file was opened, if
+    # available. Taking it at open keeps kernel read ahead out of it.
+    libc_name = ctypes.util.find_library('c')
+    __libc = ctypes.CDLL(libc_name, use_errno=True) if libc_name else None
+    if __libc is not None and not hasattr(__libc, 'mincore'):
+      __libc = None
+    __file_handle_cache.open_advice = os.POSIX_FADV_SEQUENTIAL
+    __file_handle_cache.track_residency = __libc is not None
+
+  if args.directIO:
+    if not hasattr(os, 'O_DIRECT'):
+      print('--directIO is not supported on this platform')
+      sys.exit(2)
+    __prog_options_directIO = 1
+    __file_handle_cache.extra_open_flags = os.O_DIRECT
+
+  if args.mmap:
+    __prog_options_mmap = 1
+
+  if args.cacheResidency:
+    libc_name = ctypes.util.find_library('c')
+    __libc = ctypes.CDLL(libc_name, use_errno=True) if libc_name else None
+    if __libc is None or not hasattr(__libc, 'mincore'):
+      print('--cacheResidency is not supported on this platform')
+      sys.exit(2)
+    __prog_options_cacheResidency = 1
+
+  if args.noCache:
+    __prog_options_noCache = 1
+
+  if args.cacheSize:
+    if args.cacheSize[0] < 1:
+      print('Cache size must be 1 MiB or more')
+      sys.exit(2)
+    __verify_cache_index.max_bytes = args.cacheSize[0] * 1024 * 1024
+
+  if args.rehash:
+    __prog_options_rehash = 1
+
+  if args.maxReads:
+    if args.maxReads[0] < 1:
+      print('Maximum number of reads must be 1 or more')
+      sys.exit(2)
+    __read_semaphore = threading.BoundedSemaphore(args.maxReads[0])
+
+  # --- Batch mode
+  if args.batch:
+    if data_directory == None or not (args.check or args.checkHash):
+      do_printHelp()
+      sys.exit(2)
+    num_batch_jobs = 1
+    if args.batchJobs:
+      num_batch_jobs = max(1, args.batchJobs[0])
+    ret_value = run_check(args.profile, check_torrent_batch, args.batch[0], data_directory,
+                          args.checkHash, num_batch_jobs)
+    sys.exit(ret_value)
+
+  # --- Extrant torrent metadata
+  if not torrentFileName:
+    do_printHelp()
+    sys.exit(2)
+
+  if (args.check or args.checkUnneeded or args.checkHash or args.checkFile or args.checkSample) \
+      and data_directory == None:
+    do_printHelp()
+    sys.exit(2)
+
+  if args.writeResume and not args.checkHash:
+    print('--writeResume can only be used with --checkHash')
+    sys.exit(2)
+
+  # --- Check for torrent file existence
+  if not os.path.isfile(torrentFileName):
+    print('Torrent file not found: {0}'.format(torrentFileName))
+    sys.exit(3)
+
+  # --- Read torrent file metadata  
+  try:
+    torrent_obj = extract_torrent_metadata(torrentFileName)
+  except DecodingError as e:
+    print('')
+    print(e.msg)
+    sys.exit(1)
 
-# --- Get torrent data directory and check it exists
-if data_directory != None:
-  torrent_obj.dir_download = data_directory
-  # User wants to override torrent data directory
-  if __prog_options_override_torrent_dir:
-    torrent_obj.dir_data = torrent_obj.dir_download
-  # Normal mode of operation
+  # --- Get torrent data directory and check it exists
+  if data_directory != None:
+    set_torrent_data_directory(torrent_obj, data_directory)
+    # Check that data directory exists
+    if not os.path.isdir(torrent_obj.dir_data):
+      print('Data directory not found: {0}'.format(torrent_obj.dir_data))
+      exit(4)
+
+  # Single file torrents are stored straight in the download directory,
+  # next to other torrents. Do not delete them as unneeded.
+  if __prog_options_deleteUnneeded and torrent_obj.dir_name is None and \
+     not __prog_options_override_torrent_dir:
+    print('--deleteUnneeded cannot be used with single file torrents: the data directory')
+    print('is the download directory. Use --otd if the directory only has this torrent.')
+    sys.exit(2)
+
+  # --- Decide what to do based on arguments
+  ret_value = 0
+  if __prog_options_cacheResidency and data_directory != None:
+    residency_before = get_torrent_cache_residency(torrent_obj)
+  if args.check:
+    ret_value = run_check(args.profile, check_torrent_files_only, torrent_obj)
+  elif args.checkUnneeded:
+    ret_value = run_check(args.profile, check_torrent_unneeded_files, torrent_obj)
+  elif args.checkHash:
+    ret_value = run_check(args.profile, check_torrent_files_hash, torrent_obj)
+    if args.writeResume:
+      try:
+        write_resume_file(torrent_obj, args.writeResume[0])
+      except OSError as e:
+        print('Cannot write resume file: {0}'.format(e))
+        ret_value = max(ret_value, 1)
+  elif args.checkFile:
+    fileName_list = args.checkFile
+    if fileName_list == ['-']:
+      fileName_list = [line.rstrip('\n') for line in sys.stdin if line.strip()]
+    ret_value = run_check(args.profile, check_torrent_files_single_hash, torrent_obj, fileName_list)
+  elif args.checkSample:
+    if use_v2_hash(torrent_obj):
+      print('--checkSample is not supported with BitTorrent v2 hashes')
+      sys.exit(2)
+    sample_size = get_sample_size(torrent_obj, args.checkSample[0])
+    if sample_size is None:
+      print('Sample must be a number of pieces N or a percentage P%')
+      sys.exit(2)
+    ret_value = run_check(args.profile, check_torrent_files_sample, torrent_obj, sample_size)
   else:
-    torrent_obj.dir_data = os.path.join(data_directory, torrent_obj.dir_name)
-  # Check that data directory exists
-  if not os.path.isdir(torrent_obj.dir_data):
-    print('Data directory not found: {0}'.format(torrent_obj.dir_data))
-    exit(4)
-
-# --- Decide what to do based on arguments
-ret_value = 0
-if args.check:
-  ret_value = check_torrent_files_only(torrent_obj)
-elif args.checkUnneeded:
-  ret_value = check_torrent_unneeded_files(torrent_obj)
-elif args.checkHash:
-  ret_value = check_torrent_files_hash(torrent_obj)
-elif args.checkFile:
-  ret_value = check_torrent_files_single_hash(torrent_obj, args.checkFile[0])
-else:
-  ret_value = list_torrent_contents(torrent_obj)
-sys.exit(ret_value)
+    ret_value = list_torrent_contents(torrent_obj)
+  if __prog_options_cacheResidency and data_directory != None:
+    print_cache_residency('Page cache before   ', residency_before)
+    print_cache_residency('Page cache after    ', get_torrent_cache_residency(torrent_obj))
+  sys.exit(ret_value)